@@ -2,14 +2,42 @@ import os
 import logging
 import re
 import json
-import random
 import string
+import time
+import asyncio
+import functools
+import threading
+import collections
+import heapq
+import itertools
+import hmac
+import secrets
+import signal
+import socket
+import tempfile
+import csv
+import gzip
+import io
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from datetime import datetime
+from typing import Optional, List
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 import psycopg2
 from psycopg2 import pool
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.extras
+from aiohttp import web
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError, RetryAfter, Forbidden, BadRequest, NetworkError
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
+    PersistenceInput,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
@@ -38,15 +66,390 @@ if not DATABASE_URL:
     logger.error("Missing DATABASE_URL!")
     raise ValueError("DATABASE_URL required")
 
+# Webhook mode is enabled when WEBHOOK_URL is set; otherwise the bot long-polls
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = '/' + os.environ.get('WEBHOOK_PATH', 'telegram').strip('/')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40))
+# Every worker re-registers the webhook on boot, so dropping queued updates is opt-in
+WEBHOOK_DROP_PENDING = os.environ.get('WEBHOOK_DROP_PENDING', '').lower() in ('1', 'true', 'yes')
+PORT = int(os.environ.get('PORT', 8443))
+
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    # Webhook mode is single-worker: user_data and the per-user update ordering are held
+    # in this process and state is only written back every STATE_FLUSH_INTERVAL
+    logger.error("Missing WEBHOOK_SECRET!")
+    raise ValueError("WEBHOOK_SECRET required when WEBHOOK_URL is set")
+
+# Max updates handled at once; updates from the same user are still processed in order
+UPDATE_CONCURRENCY = int(os.environ.get('UPDATE_CONCURRENCY', 32))
+# Updates accepted at once, including those waiting behind the same user's earlier updates
+UPDATE_BACKLOG = int(os.environ.get('UPDATE_BACKLOG', 1024))
+# Per-user anti-flood: sustained updates per second and burst size; the admin is exempt
+FLOOD_RATE = float(os.environ.get('FLOOD_RATE', 1))
+FLOOD_BURST = float(os.environ.get('FLOOD_BURST', 5))
+# Identical callbacks from one user within this many seconds run the handler once
+CALLBACK_COALESCE_WINDOW = float(os.environ.get('CALLBACK_COALESCE_WINDOW', 1.0))
+
+# Every Bot API call goes through OutboundRateLimiter: one global budget shared in
+# priority order (interactive > notification > broadcast) plus a per-chat budget
+OUTBOUND_RATE = float(os.environ.get('OUTBOUND_RATE', 30))
+OUTBOUND_CHAT_RATE = float(os.environ.get('OUTBOUND_CHAT_RATE', 1))
+OUTBOUND_CHAT_BURST = float(os.environ.get('OUTBOUND_CHAT_BURST', 3))
+OUTBOUND_MAX_RETRIES = int(os.environ.get('OUTBOUND_MAX_RETRIES', 2))
+
+# /message broadcast pacing; Telegram allows roughly 30 messages per second overall
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', 25))
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', 8))
+BROADCAST_MAX_ATTEMPTS = int(os.environ.get('BROADCAST_MAX_ATTEMPTS', 5))
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get('BROADCAST_PROGRESS_INTERVAL', 10))
+# A running job is owned by one process; the lease is renewed on every progress tick and
+# a job whose lease expired (owner died) is taken over by another process
+BROADCAST_LEASE = float(os.environ.get('BROADCAST_LEASE', 60))
+PROCESS_ID = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+BROADCAST_PAGE_SIZE = 1000
+BROADCAST_FLUSH_SIZE = 200
+
+# Background queue for per-user notifications (e.g. bulk /sendcoin)
+NOTIFICATION_RATE = float(os.environ.get('NOTIFICATION_RATE', 10))
+NOTIFICATION_WORKERS = int(os.environ.get('NOTIFICATION_WORKERS', 4))
+NOTIFICATION_MAX_ATTEMPTS = 3
+NOTIFICATION_DRAIN_TIMEOUT = float(os.environ.get('NOTIFICATION_DRAIN_TIMEOUT', 10))
+NOTIFICATION_MAX_PENDING = int(os.environ.get('NOTIFICATION_MAX_PENDING', 50000))
+BULK_CREDIT_MAX_FILE_SIZE = 5 * 1024 * 1024
+
+# Wallet exports are streamed from a server-side cursor into a spooled buffer
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', 2000))
+EXPORT_SPOOL_SIZE = int(os.environ.get('EXPORT_SPOOL_SIZE', 8 * 1024 * 1024))
+# Bots can upload documents up to 50 MB; larger exports are split into parts
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 45 * 1024 * 1024))
+
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 20))
+DB_ACQUIRE_TIMEOUT = float(os.environ.get('DB_ACQUIRE_TIMEOUT', 10))
+DB_CONN_MAX_AGE = float(os.environ.get('DB_CONN_MAX_AGE', 1800))
+DB_CONN_CHECK_AFTER = float(os.environ.get('DB_CONN_CHECK_AFTER', 30))
+DB_SLOW_QUERY_MS = float(os.environ.get('DB_SLOW_QUERY_MS', 200))
+USERNAME_CACHE_SIZE = int(os.environ.get('USERNAME_CACHE_SIZE', 10000))
+USERNAME_CACHE_TTL = float(os.environ.get('USERNAME_CACHE_TTL', 300))
+TASK_DEDUPE_CACHE_SIZE = int(os.environ.get('TASK_DEDUPE_CACHE_SIZE', 50000))
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', 50000))
+PROFILE_CACHE_TTL = float(os.environ.get('PROFILE_CACHE_TTL', 60))
+# Seconds between writes of changed context.user_data to the user_state table
+STATE_FLUSH_INTERVAL = float(os.environ.get('STATE_FLUSH_INTERVAL', 10))
+
+# Prometheus text-format metrics, served on /metrics. Kept in-process and thread-safe,
+# since DB timings are recorded from executor threads.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # if set, /metrics requires "Authorization: Bearer <token>"
+# /metrics is never served on the public PORT, only on this listener (disabled when 0)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = collections.defaultdict(float)
+        if not self.labels:
+            self._values[()] = 0.0  # expose 0 before the first increment
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, [('le', bound)])} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, [('le', '+Inf')])} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {series[-1]}")
+        return lines
+
+class Gauge:
+    # Read at scrape time; func returns a number, or {label value: number} for a labelled gauge
+    def __init__(self, name: str, help_text: str, func, label: Optional[str] = None):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        self.label = label
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.func()
+        except Exception as e:
+            logger.debug(f"Gauge {self.name} unavailable: {e}")
+            return lines
+        if self.label:
+            for label_value, number in value.items():
+                lines.append(f"{self.name}{_format_labels([self.label], [label_value])} {number}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+handler_latency = metrics.register(Histogram('solium_handler_seconds', 'Handler run time', ['handler']))
+statement_latency = metrics.register(Histogram('solium_db_statement_seconds', 'Database statement time', ['statement']))
+pool_wait = metrics.register(Histogram('solium_db_pool_wait_seconds', 'Time spent waiting for a pooled connection'))
+telegram_latency = metrics.register(Histogram('solium_telegram_request_seconds', 'Bot API call time', ['endpoint']))
+telegram_errors = metrics.register(Counter('solium_telegram_errors_total', 'Failed Bot API calls', ['endpoint', 'error']))
+pool_timeouts = metrics.register(Counter('solium_db_pool_timeouts_total', 'Connection acquires that timed out'))
+flood_dropped = metrics.register(Counter('solium_flood_dropped_total', 'Updates dropped by the flood guard', ['reason']))
+
+def timed(func):
+    # Records the handler's run time in solium_handler_seconds
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            handler_latency.observe(time.perf_counter() - started, func.__name__)
+    return wrapper
+
 db_pool = None
+db_executor = None
+user_repository = None
+
+class PreparedConnection(psycopg2.extensions.connection):
+    # Tracks which server-side prepared statements exist on this session
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+        self.created_at = time.monotonic()
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    pass
+
+class ConnectionPool:
+    # Thread-safe pool: waiters queue up to acquire_timeout, idle connections are
+    # health-checked before reuse and connections are recycled after max_age.
+    def __init__(self, minconn, maxconn, acquire_timeout, max_age, check_after, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.acquire_timeout = acquire_timeout
+        self.max_age = max_age
+        self.check_after = check_after
+        self._connect_kwargs = connect_kwargs
+        self._cond = threading.Condition()
+        self._idle = collections.deque()  # (conn, returned_at), most recently used on the right
+        self._in_use = set()
+        self._size = 0
+        self._waiting = 0
+        self._closed = False
+        self._acquired = 0
+        self._timeouts = 0
+        self._recycled = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _connect(self):
+        return psycopg2.connect(connection_factory=PreparedConnection, **self._connect_kwargs)
+
+    def prewarm(self, count=None):
+        count = self.minconn if count is None else count
+        opened = []
+        with self._cond:
+            count = max(0, min(count - len(self._idle), self.maxconn - self._size))
+            self._size += count
+        try:
+            for _ in range(count):
+                opened.append(self._connect())
+        finally:
+            with self._cond:
+                self._size -= count - len(opened)
+                now = time.monotonic()
+                self._idle.extend((conn, now) for conn in opened)
+                self._cond.notify_all()
+        logger.info(f"Connection pool pre-warmed with {len(opened)} connections")
+
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.acquire_timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise psycopg2.pool.PoolError("connection pool is closed")
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    conn, returned_at = None, None
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    pool_timeouts.inc()
+                    raise PoolTimeout(f"no connection available within {self.acquire_timeout}s")
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+        
+        try:
+            if conn is None:
+                conn = self._connect()
+            else:
+                conn = self._validate(conn, returned_at)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        
+        waited = time.monotonic() - started
+        pool_wait.observe(waited)
+        with self._cond:
+            self._in_use.add(conn)
+            self._acquired += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def _validate(self, conn, returned_at):
+        now = time.monotonic()
+        if conn.closed or now - conn.created_at > self.max_age:
+            self._discard(conn, recycled=True)
+            return self._connect()
+        if now - returned_at > self.check_after:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error as e:
+                # Typically a socket left dead by a Postgres failover or restart
+                logger.warning(f"Discarding dead pooled connection: {e}")
+                self._discard(conn, recycled=True)
+                return self._connect()
+        return conn
+
+    def _discard(self, conn, recycled=False):
+        if recycled:
+            with self._cond:
+                self._recycled += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def putconn(self, conn, close=False):
+        if not close and not conn.closed:
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+        recycled = not close and time.monotonic() - conn.created_at > self.max_age
+        close = close or recycled
+        
+        with self._cond:
+            self._in_use.discard(conn)
+            if close or conn.closed or self._closed:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if close or self._closed:
+            self._discard(conn, recycled=recycled)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._size,
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'max': self.maxconn,
+                'acquired': self._acquired,
+                'timeouts': self._timeouts,
+                'recycled': self._recycled,
+                'wait_avg_ms': (self._wait_total / self._acquired * 1000) if self._acquired else 0.0,
+                'wait_max_ms': self._wait_max * 1000,
+            }
 
 def init_db_pool():
-    global db_pool
+    global db_pool, db_executor, user_repository
     try:
         url = urlparse(DATABASE_URL)
-        db_pool = psycopg2.pool.SimpleConnectionPool(
-            minconn=1,
-            maxconn=20,
+        db_pool = ConnectionPool(
+            minconn=DB_POOL_MIN,
+            maxconn=DB_POOL_MAX,
+            acquire_timeout=DB_ACQUIRE_TIMEOUT,
+            max_age=DB_CONN_MAX_AGE,
+            check_after=DB_CONN_CHECK_AFTER,
             database=url.path[1:],
             user=url.username,
             password=url.password,
@@ -54,21 +457,34 @@ def init_db_pool():
             port=url.port,
             sslmode='require'
         )
+        db_pool.prewarm()
+        # One worker per pooled connection, so queued DB calls wait in the executor
+        # instead of exhausting the pool or blocking the event loop
+        db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix='db')
+        user_repository = UserRepository(db_pool)
         logger.info("✅ Database connection pool initialized")
     except Exception as e:
         logger.error(f"Database connection failed: {str(e)}")
         raise
 
-def init_db():
-    conn = None
-    cursor = None
-    try:
-        conn = db_pool.getconn()
-        cursor = conn.cursor()
-        
-        logger.info("Initializing DB tables...")
-        
-        cursor.execute('''
+async def run_db(func, *args):
+    # Every handler goes through here so psycopg2 calls never run on the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args))
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    statements: List[str]
+    # CREATE INDEX CONCURRENTLY can't run in a transaction; these run statement by
+    # statement in autocommit mode and don't block writes to the table
+    concurrently: bool = False
+
+# Append only; never edit a migration that has shipped
+MIGRATIONS = [
+    Migration(1, 'users table', [
+        '''
             CREATE TABLE IF NOT EXISTS users (
                 user_id BIGINT PRIMARY KEY,
                 username TEXT,
@@ -90,41 +506,1002 @@ def init_db():
                 created_at TIMESTAMP DEFAULT NOW(),
                 updated_at TIMESTAMP DEFAULT NOW()
             )
-        ''')
-        
+        ''',
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_code VARCHAR(10)",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_count INTEGER DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_rewards INTEGER DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_referrer_id ON users(referrer_id)",
+        "CREATE INDEX IF NOT EXISTS idx_participated ON users(participated)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_referral_code ON users(referral_code) WHERE referral_code IS NOT NULL",
+    ]),
+    # Broadcast jobs and per-recipient delivery state, so /message survives restarts
+    Migration(2, 'broadcast jobs', [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_bot BOOLEAN DEFAULT FALSE NOT NULL",
+        '''
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                job_id SERIAL PRIMARY KEY,
+                admin_chat_id BIGINT NOT NULL,
+                message_text TEXT NOT NULL,
+                status TEXT DEFAULT 'running' NOT NULL CHECK (status IN ('running', 'completed', 'failed')),
+                created_at TIMESTAMP DEFAULT NOW(),
+                finished_at TIMESTAMP
+            )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                job_id INTEGER NOT NULL REFERENCES broadcast_jobs(job_id) ON DELETE CASCADE,
+                user_id BIGINT NOT NULL,
+                status TEXT DEFAULT 'pending' NOT NULL CHECK (status IN ('pending', 'sent', 'failed', 'blocked')),
+                updated_at TIMESTAMP DEFAULT NOW(),
+                PRIMARY KEY (job_id, user_id)
+            )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_pending ON broadcast_deliveries(job_id, user_id) WHERE status = 'pending'",
+    ]),
+    # Markers for delta wallet exports
+    Migration(3, 'wallet exports', [
+        '''
+            CREATE TABLE IF NOT EXISTS wallet_exports (
+                export_id SERIAL PRIMARY KEY,
+                exported_at TIMESTAMP NOT NULL,
+                row_count INTEGER NOT NULL,
+                delta BOOLEAN NOT NULL
+            )
+        ''',
+    ]),
+    # Case-insensitive username lookups and delta exports by updated_at
+    Migration(4, 'users lookup indexes', [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_username_lower ON users(lower(username))",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_updated_at ON users(updated_at)",
+    ], concurrently=True),
+    # Task catalog, editable without a deploy (then /reload_tasks)
+    Migration(5, 'tasks table', [
+        '''
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_number INTEGER PRIMARY KEY CHECK (task_number >= 1),
+                title TEXT NOT NULL,
+                description TEXT NOT NULL,
+                reward INTEGER DEFAULT 20 NOT NULL CHECK (reward >= 0),
+                button_text TEXT,
+                button_callback TEXT
+            )
+        ''',
+        '''
+            INSERT INTO tasks (task_number, title, description, reward, button_text, button_callback) VALUES
+            (1, $$1️⃣ Join Our Telegram Group$$,
+             $$Join the official Solium Telegram group @soliumcoinchat to stay updated on project announcements and community events.
+
+<a href='https://t.me/soliumcoinchat'>Click here to join</a>$$, 20, NULL, NULL),
+            (2, $$2️⃣ Follow Our Telegram Channel$$,
+             $$Follow the Solium Telegram channel for the latest news and updates.
+
+<a href='https://t.me/soliumcoin'>Click here to follow</a>$$, 20, NULL, NULL),
+            (3, $$3️⃣ Follow Solium on X$$,
+             $$Follow our official X account (@soliumcoin) to get real-time updates.
+
+<a href='https://x.com/soliumcoin'>Click here to follow</a>$$, 20, NULL, NULL),
+            (4, $$4️⃣ Retweet Our Pinned Post$$,
+             $$Retweet the pinned post on our X account to spread the word about Solium.
+
+<a href='https://x.com/soliumcoin'>Click here to retweet</a>$$, 20, NULL, NULL),
+            (5, $$5️⃣ Enter Your BSC Wallet$$,
+             $$Provide your Binance Smart Chain (BSC) wallet address to receive your Solium rewards.
+
+Click the 'Enter Address' button below and send your wallet address (e.g., 0x...).$$, 20, 'Enter Address', 'task_5_wallet')
+            ON CONFLICT (task_number) DO NOTHING
+        ''',
+    ]),
+    # Task completions as rows instead of task1..task5 columns, so campaigns can have
+    # any number of tasks. The legacy taskN_completed columns are kept but no longer written.
+    Migration(6, 'user tasks', [
+        "ALTER TABLE tasks ADD COLUMN IF NOT EXISTS kind TEXT DEFAULT 'visit' NOT NULL CHECK (kind IN ('visit', 'wallet'))",
+        "UPDATE tasks SET kind = 'wallet' WHERE button_callback = 'task_5_wallet'",
+        '''
+            CREATE TABLE IF NOT EXISTS user_tasks (
+                user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+                task_number INTEGER NOT NULL,
+                reward INTEGER NOT NULL,
+                completed_at TIMESTAMP DEFAULT NOW() NOT NULL,
+                PRIMARY KEY (user_id, task_number)
+            )
+        ''',
+        '''
+            INSERT INTO user_tasks (user_id, task_number, reward, completed_at)
+            SELECT u.user_id, t.task_number, 20, u.updated_at
+            FROM users u
+            CROSS JOIN LATERAL (VALUES
+                (1, u.task1_completed), (2, u.task2_completed), (3, u.task3_completed),
+                (4, u.task4_completed), (5, u.task5_completed)
+            ) AS t(task_number, completed)
+            WHERE t.completed
+            ON CONFLICT DO NOTHING
+        ''',
+        # NOT VALID skips re-checking existing rows under lock; new rows are still checked
+        "ALTER TABLE users DROP CONSTRAINT IF EXISTS users_current_task_check",
+        "ALTER TABLE users ADD CONSTRAINT users_current_task_check CHECK (current_task >= 1) NOT VALID",
+    ]),
+    # context.user_data (awaiting_wallet / awaiting_referral) survives restarts
+    Migration(7, 'user state', [
+        '''
+            CREATE TABLE IF NOT EXISTS user_state (
+                user_id BIGINT PRIMARY KEY,
+                data JSONB NOT NULL,
+                updated_at TIMESTAMP DEFAULT NOW() NOT NULL
+            )
+        ''',
+    ]),
+    # Broadcast job ownership, so two processes never send the same job
+    Migration(8, 'broadcast job leases', [
+        "ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS owner TEXT",
+        "ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP",
+    ]),
+]
+
+MIGRATION_LOCK_ID = 727100  # pg_advisory_lock key so only one dyno migrates at a time
+MIGRATION_LOCK_POLL = 1.0  # seconds between pg_try_advisory_lock attempts
+
+def _acquire_migration_lock(conn):
+    # Polls instead of blocking in pg_advisory_lock: a waiting session would hold a
+    # snapshot that CREATE INDEX CONCURRENTLY in the migrating dyno has to wait for
+    waited = 0.0
+    while True:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+            acquired = cursor.fetchone()[0]
+        conn.commit()
+        if acquired:
+            return
+        if waited % 30 == 0:
+            logger.info("Waiting for another process to finish migrating...")
+        time.sleep(MIGRATION_LOCK_POLL)
+        waited += MIGRATION_LOCK_POLL
+
+def _schema_version(cursor) -> int:
+    cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return 0
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    return cursor.fetchone()[0]
+
+def _drop_invalid_index(cursor, statement):
+    # A failed CREATE INDEX CONCURRENTLY leaves an INVALID index that IF NOT EXISTS would skip
+    match = re.search(r'INDEX CONCURRENTLY IF NOT EXISTS (\w+)', statement)
+    if not match:
+        return
+    cursor.execute('''
+        SELECT 1
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND NOT i.indisvalid
+    ''', (match.group(1),))
+    if cursor.fetchone():
+        logger.warning(f"Dropping invalid index {match.group(1)} left by an interrupted migration")
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {match.group(1)}")
+
+def _apply_migration(conn, migration):
+    logger.info(f"Applying migration {migration.version}: {migration.name}")
+    if migration.concurrently:
+        conn.autocommit = True
         try:
-            cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_code VARCHAR(10)")
-            cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_count INTEGER DEFAULT 0")
-            cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_rewards INTEGER DEFAULT 0")
-        except Exception as e:
-            logger.warning(f"Column addition warning: {e}")
+            with conn.cursor() as cursor:
+                for statement in migration.statements:
+                    _drop_invalid_index(cursor, statement)
+                    cursor.execute(statement)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                    (migration.version, migration.name)
+                )
+        finally:
+            conn.autocommit = False
+    else:
+        with conn.cursor() as cursor:
+            for statement in migration.statements:
+                cursor.execute(statement)
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                (migration.version, migration.name)
+            )
+        conn.commit()
+
+def init_db():
+    latest = MIGRATIONS[-1].version
+    conn = None
+    try:
+        conn = db_pool.getconn()
         
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_referrer_id ON users(referrer_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_participated ON users(participated)")
+        # Common case: schema is current, a single read and no locks on users
+        with conn.cursor() as cursor:
+            current = _schema_version(cursor)
+        conn.commit()
+        if current >= latest:
+            logger.info(f"✅ Database schema up to date (version {current})")
+            return
         
+        _acquire_migration_lock(conn)
         try:
-            cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_referral_code ON users(referral_code) WHERE referral_code IS NOT NULL")
-        except Exception as e:
-            logger.warning(f"Index creation warning: {e}")
-            cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_code VARCHAR(10)")
-            cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_referral_code ON users(referral_code) WHERE referral_code IS NOT NULL")
+            with conn.cursor() as cursor:
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        applied_at TIMESTAMP DEFAULT NOW() NOT NULL
+                    )
+                ''')
+                # Another dyno may have migrated while we waited for the lock
+                current = _schema_version(cursor)
+            conn.commit()
+            
+            for migration in MIGRATIONS:
+                if migration.version > current:
+                    _apply_migration(conn, migration)
+        finally:
+            # Session-level lock, still held after a failed migration is rolled back
+            conn.rollback()
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+            conn.commit()
         
-        conn.commit()
-        logger.info("✅ Database initialized")
+        logger.info(f"✅ Database migrated from version {current} to {latest}")
     except Exception as e:
         logger.error(f"DB initialization failed: {e}", exc_info=True)
         if conn:
             conn.rollback()
         raise
     finally:
-        if cursor:
-            cursor.close()
         if conn:
             db_pool.putconn(conn)
 
+REFERRAL_CODE_ALPHABET = string.ascii_uppercase + string.digits
+REFERRAL_CODE_ATTEMPTS = 5
+
 def generate_referral_code():
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+    return ''.join(secrets.choice(REFERRAL_CODE_ALPHABET) for _ in range(8))
+
+@dataclass
+class UserRecord:
+    user_id: int
+    username: Optional[str]
+    bsc_address: Optional[str]
+    balance: int
+    referral_code: Optional[str]
+    referral_count: int
+    referral_rewards: int
+    participated: bool
+    current_task: int
+    has_referred: bool
+    referrer_id: Optional[int]
+
+@dataclass
+class RegistrationResult:
+    user: UserRecord
+    new_referral_code: Optional[str] = None
+    referral: Optional['ReferralResult'] = None  # set when /start carried a referral code
+
+@dataclass(frozen=True)
+class Profile:
+    # What the Balance button shows
+    balance: int
+    referral_code: Optional[str]
+    referral_count: int
+    referral_rewards: int
+
+@dataclass
+class TaskCompletion:
+    balance: int
+    credited: int  # 0 when the task was already completed
+
+@dataclass
+class ReferralResult:
+    status: str  # ok, not_found, already_referred, own_code, invalid_code
+    referrer_id: Optional[int] = None
+    referrer_balance: Optional[int] = None
+    user_balance: Optional[int] = None
+
+@dataclass
+class AirdropResult:
+    status: str  # ok, not_found, already_completed, no_wallet
+    bsc_address: Optional[str] = None
+    username: Optional[str] = None
+    final_balance: Optional[int] = None
+    referrer_id: Optional[int] = None
+    referrer_balance: Optional[int] = None
+
+# Server-side prepared statements, PREPAREd once per pooled connection
+STATEMENTS = {
+    'get_user': '''
+        SELECT user_id, username, bsc_address, balance, referral_code, referral_count,
+               referral_rewards, participated, current_task, has_referred, referrer_id
+        FROM users
+        WHERE user_id = $1
+    ''',
+    # Creates the user or refreshes the username (clearing blocked_bot) in one round-trip;
+    # $3 is only kept when the user has no referral code yet
+    'register_user': '''
+        INSERT INTO users (user_id, username, referral_code)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (user_id) DO UPDATE
+        SET username = EXCLUDED.username,
+            referral_code = COALESCE(users.referral_code, EXCLUDED.referral_code),
+            blocked_bot = FALSE,
+            updated_at = NOW()
+        RETURNING user_id, username, bsc_address, balance, referral_code, referral_count,
+                  referral_rewards, participated, current_task, has_referred, referrer_id,
+                  referral_code = $3
+    ''',
+    # Credits the reward only when the user_tasks row is new, so repeats are free no-ops
+    'complete_task': '''
+        WITH done AS (
+            INSERT INTO user_tasks (user_id, task_number, reward)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (user_id, task_number) DO NOTHING
+            RETURNING reward
+        )
+        UPDATE users
+        SET balance = balance + COALESCE((SELECT reward FROM done), 0),
+            current_task = GREATEST(current_task, $2 + 1),
+            updated_at = NOW()
+        WHERE user_id = $1
+        RETURNING balance, COALESCE((SELECT reward FROM done), 0)
+    ''',
+    'save_wallet': '''
+        WITH done AS (
+            INSERT INTO user_tasks (user_id, task_number, reward)
+            VALUES ($1, $3, $4)
+            ON CONFLICT (user_id, task_number) DO NOTHING
+            RETURNING reward
+        )
+        UPDATE users
+        SET bsc_address = $2,
+            balance = balance + COALESCE((SELECT reward FROM done), 0),
+            current_task = GREATEST(current_task, $3 + 1),
+            updated_at = NOW()
+        WHERE user_id = $1
+        RETURNING balance, COALESCE((SELECT reward FROM done), 0)
+    ''',
+    # One round-trip referral. "WHERE NOT has_referred" takes the row lock and is re-checked
+    # after any concurrent referral commits, so only one submission can ever credit; the
+    # referrer is only credited when that update happened. The outer SELECT sees the
+    # pre-update snapshot, which is what the status is derived from.
+    'apply_referral': '''
+        WITH referrer AS (
+            SELECT user_id
+            FROM users
+            WHERE referral_code = $2 AND user_id <> $1
+        ), referred AS (
+            UPDATE users
+            SET referrer_id = (SELECT user_id FROM referrer),
+                has_referred = TRUE,
+                balance = balance + 20,
+                updated_at = NOW()
+            WHERE user_id = $1 AND NOT has_referred AND EXISTS (SELECT 1 FROM referrer)
+            RETURNING balance
+        ), credited AS (
+            UPDATE users
+            SET referrals = referrals + 1,
+                referral_count = referral_count + 1,
+                balance = balance + 20,
+                referral_rewards = referral_rewards + 20,
+                updated_at = NOW()
+            WHERE user_id = (SELECT user_id FROM referrer) AND EXISTS (SELECT 1 FROM referred)
+            RETURNING balance
+        )
+        SELECT u.user_id IS NOT NULL, u.has_referred, u.referral_code = $2,
+               (SELECT user_id FROM referrer),
+               (SELECT balance FROM referred),
+               (SELECT balance FROM credited)
+        FROM (SELECT 1) AS one
+        LEFT JOIN users u ON u.user_id = $1
+    ''',
+    'finalize_airdrop': '''
+        UPDATE users
+        SET participated = TRUE,
+            balance = balance + 100,
+            updated_at = NOW()
+        WHERE user_id = $1
+        RETURNING balance
+    ''',
+    'reward_referrer': '''
+        UPDATE users
+        SET balance = balance + 20,
+            referral_rewards = referral_rewards + 20,
+            updated_at = NOW()
+        WHERE user_id = $1
+        RETURNING balance
+    ''',
+    'find_user_by_username': '''
+        SELECT user_id
+        FROM users
+        WHERE lower(username) = lower($1)
+        ORDER BY updated_at DESC
+        LIMIT 1
+    ''',
+    'credit_balance': '''
+        UPDATE users
+        SET balance = balance + $2,
+            updated_at = NOW()
+        WHERE user_id = $1
+        RETURNING balance
+    ''',
+    'create_broadcast_job': '''
+        WITH job AS (
+            INSERT INTO broadcast_jobs (admin_chat_id, message_text, owner, heartbeat_at)
+            VALUES ($1, $2, $3, NOW())
+            RETURNING job_id
+        ), queued AS (
+            INSERT INTO broadcast_deliveries (job_id, user_id)
+            SELECT job.job_id, users.user_id
+            FROM job, users
+            WHERE NOT users.blocked_bot
+            RETURNING 1
+        )
+        SELECT job_id, (SELECT COUNT(*) FROM queued)
+        FROM job
+    ''',
+    # The row lock makes competing claims re-check the lease, so only one process wins
+    'claim_broadcast_jobs': '''
+        UPDATE broadcast_jobs
+        SET owner = $1,
+            heartbeat_at = NOW()
+        WHERE status = 'running'
+          AND (heartbeat_at IS NULL OR heartbeat_at < NOW() - $2::float8 * INTERVAL '1 second')
+        RETURNING job_id, admin_chat_id, message_text
+    ''',
+    'renew_broadcast_lease': '''
+        UPDATE broadcast_jobs
+        SET heartbeat_at = NOW()
+        WHERE job_id = $1 AND owner = $2 AND status = 'running'
+        RETURNING job_id
+    ''',
+    'release_broadcast_job': '''
+        UPDATE broadcast_jobs
+        SET heartbeat_at = NULL
+        WHERE job_id = $1 AND owner = $2 AND status = 'running'
+    ''',
+    'delivery_counts': '''
+        SELECT status, COUNT(*)
+        FROM broadcast_deliveries
+        WHERE job_id = $1
+        GROUP BY status
+    ''',
+    'pending_deliveries': '''
+        SELECT user_id
+        FROM broadcast_deliveries
+        WHERE job_id = $1 AND status = 'pending' AND user_id > $2
+        ORDER BY user_id
+        LIMIT $3
+    ''',
+    'record_deliveries': '''
+        UPDATE broadcast_deliveries d
+        SET status = v.status,
+            updated_at = NOW()
+        FROM unnest($2::bigint[], $3::text[]) AS v(user_id, status)
+        WHERE d.job_id = $1 AND d.user_id = v.user_id
+    ''',
+    'mark_blocked': '''
+        UPDATE users
+        SET blocked_bot = TRUE
+        WHERE user_id = ANY($1::bigint[])
+    ''',
+    'load_tasks': '''
+        SELECT task_number, title, description, reward, button_text, button_callback, kind
+        FROM tasks
+        ORDER BY task_number
+    ''',
+    'last_wallet_export': '''
+        SELECT MAX(exported_at)
+        FROM wallet_exports
+    ''',
+    'wallet_export_snapshot': '''
+        SELECT NOW() - INTERVAL '1 minute'
+    ''',
+    'record_wallet_export': '''
+        INSERT INTO wallet_exports (exported_at, row_count, delta)
+        VALUES ($1, $2, $3)
+    ''',
+    'load_user_states': '''
+        SELECT user_id, data
+        FROM user_state
+    ''',
+    'save_user_state': '''
+        INSERT INTO user_state (user_id, data)
+        VALUES ($1, $2)
+        ON CONFLICT (user_id) DO UPDATE
+        SET data = EXCLUDED.data,
+            updated_at = NOW()
+    ''',
+    'delete_user_state': '''
+        DELETE FROM user_state
+        WHERE user_id = $1
+    ''',
+    'finish_broadcast_job': '''
+        UPDATE broadcast_jobs
+        SET status = $2,
+            finished_at = NOW()
+        WHERE job_id = $1
+    ''',
+}
+
+class TTLCache:
+    # Small thread-safe LRU with a per-entry TTL; expired entries are dropped on read
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # key -> (value, expires)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+class UsernameCache(TTLCache):
+    # lower(username) -> user_id, so repeated admin lookups skip the database; only hits are cached
+    def get(self, username) -> Optional[int]:
+        if not username:
+            return None
+        return super().get(username.lower())
+
+    def put(self, username, user_id):
+        super().put(username.lower(), user_id)
+
+class ProfileCache(TTLCache):
+    # user_id -> Profile. Repository write paths refresh the balance or drop the entry
+    # after commit; the TTL bounds staleness from writes made elsewhere (other workers,
+    # manual SQL).
+    def update_balance(self, user_id, balance):
+        # Only refreshes users that are already cached
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry:
+                self._entries[user_id] = (replace(entry[0], balance=balance), entry[1])
+
+class CompletedTaskCache:
+    # LRU of user_id -> task numbers known to be in user_tasks, so repeated "Next" taps and
+    # replayed callbacks are dropped before reaching the database. Completions are never
+    # undone, so entries need no TTL. Only touched from the event loop, hence no lock.
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+
+    def contains(self, user_id, task_number) -> bool:
+        tasks = self._entries.get(user_id)
+        if tasks is None:
+            return False
+        self._entries.move_to_end(user_id)
+        return task_number in tasks
+
+    def add(self, user_id, task_number):
+        self._entries.setdefault(user_id, set()).add(task_number)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+completed_tasks = CompletedTaskCache(TASK_DEDUPE_CACHE_SIZE)
+
+@dataclass
+class BulkCreditResult:
+    credited: list  # [(user_id, amount, new_balance)]
+    unknown: list  # [(line, target)]
+
+class UserRepository:
+    def __init__(self, connection_pool):
+        self.pool = connection_pool
+        self._stats_lock = threading.Lock()
+        # statement name -> [calls, total seconds, max seconds]
+        self.statement_stats = {}
+        self.usernames = UsernameCache(USERNAME_CACHE_SIZE, USERNAME_CACHE_TTL)
+        self.profiles = ProfileCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+    @contextmanager
+    def transaction(self, cursor_name=None):
+        # A cursor_name gives a server-side (named) cursor that fetches rows lazily
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor(name=cursor_name) as cursor:
+                yield cursor
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+                self._reset_prepared(conn)
+            except psycopg2.Error:
+                pass  # broken connection, putconn() discards it
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    def _reset_prepared(self, conn):
+        # After an error we can't tell which PREPAREs survived, so start clean
+        if not conn.prepared or conn.closed:
+            return
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("DEALLOCATE ALL")
+            conn.commit()
+            conn.prepared.clear()
+        except psycopg2.Error as e:
+            logger.warning(f"Failed to reset prepared statements: {e}")
+
+    def _prepare(self, cursor, name):
+        conn = cursor.connection
+        if name not in conn.prepared:
+            cursor.execute(f"PREPARE {name} AS {STATEMENTS[name]}")
+            conn.prepared.add(name)
+
+    def _record(self, name, elapsed):
+        statement_latency.observe(elapsed, name)
+        with self._stats_lock:
+            stats = self.statement_stats.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+        if elapsed * 1000 >= DB_SLOW_QUERY_MS:
+            logger.warning(f"Slow query {name}: {elapsed * 1000:.1f} ms")
+
+    def execute(self, cursor, name, *params):
+        self._prepare(cursor, name)
+        placeholders = f" ({', '.join(['%s'] * len(params))})" if params else ''
+        started = time.perf_counter()
+        cursor.execute(f"EXECUTE {name}{placeholders}", params or None)
+        self._record(name, time.perf_counter() - started)
+
+    def execute_batch(self, cursor, name, params_list, page_size=500):
+        # Sends page_size EXECUTEs per round-trip
+        params_list = list(params_list)
+        if not params_list:
+            return
+        self._prepare(cursor, name)
+        placeholders = ', '.join(['%s'] * len(params_list[0]))
+        started = time.perf_counter()
+        psycopg2.extras.execute_batch(cursor, f"EXECUTE {name} ({placeholders})", params_list, page_size=page_size)
+        self._record(f"{name}[batch]", time.perf_counter() - started)
+
+    def _fetch_user(self, cursor, user_id):
+        self.execute(cursor, 'get_user', user_id)
+        row = cursor.fetchone()
+        return UserRecord(*row) if row else None
+
+    def get_user(self, user_id) -> Optional[UserRecord]:
+        with self.transaction() as cursor:
+            return self._fetch_user(cursor, user_id)
+
+    def _cache_profile(self, user: UserRecord) -> Profile:
+        profile = Profile(user.balance, user.referral_code, user.referral_count, user.referral_rewards)
+        self.profiles.put(user.user_id, profile)
+        return profile
+
+    def get_profile(self, user_id) -> Optional[Profile]:
+        profile = self.profiles.get(user_id)
+        if profile:
+            return profile
+        user = self.get_user(user_id)
+        return self._cache_profile(user) if user else None
+
+    def _referral_applied(self, user_id, result: 'ReferralResult'):
+        # Called after commit: the user's balance moved, the referrer's counters too
+        if result.status == 'ok':
+            self.profiles.update_balance(user_id, result.user_balance)
+            self.profiles.invalidate(result.referrer_id)
+
+    def register_user(self, user_id, username, start_referral_code=None) -> RegistrationResult:
+        for attempt in range(1, REFERRAL_CODE_ATTEMPTS + 1):
+            referral_code = generate_referral_code()
+            try:
+                with self.transaction() as cursor:
+                    self.execute(cursor, 'register_user', user_id, username, referral_code)
+                    *row, issued = cursor.fetchone()
+                    user = UserRecord(*row)
+                    referral = None
+                    if start_referral_code:
+                        referral = self._apply_referral(cursor, user_id, start_referral_code)
+                        if referral.status == 'ok':
+                            user.balance = referral.user_balance
+                            user.has_referred = True
+                            user.referrer_id = referral.referrer_id
+            except psycopg2.errors.UniqueViolation as e:
+                # Another user already holds this code; draw a fresh one
+                if e.diag.constraint_name != 'idx_referral_code' or attempt == REFERRAL_CODE_ATTEMPTS:
+                    raise
+                logger.warning(f"Referral code collision for user {user_id}, retrying ({attempt}/{REFERRAL_CODE_ATTEMPTS})")
+                continue
+            
+            if username:
+                self.usernames.put(username, user_id)
+            self._cache_profile(user)
+            if referral:
+                self._referral_applied(user_id, referral)
+            return RegistrationResult(user, referral_code if issued else None, referral)
+
+    def complete_task(self, user_id, task_number, reward) -> Optional[TaskCompletion]:
+        with self.transaction() as cursor:
+            self.execute(cursor, 'complete_task', user_id, task_number, reward)
+            row = cursor.fetchone()
+        if not row:
+            return None
+        self.profiles.update_balance(user_id, row[0])
+        return TaskCompletion(*row)
+
+    def save_wallet(self, user_id, wallet_address, task_number, reward) -> Optional[TaskCompletion]:
+        with self.transaction() as cursor:
+            self.execute(cursor, 'save_wallet', user_id, wallet_address, task_number, reward)
+            row = cursor.fetchone()
+        if not row:
+            return None
+        self.profiles.update_balance(user_id, row[0])
+        return TaskCompletion(*row)
+
+    def _apply_referral(self, cursor, user_id, referral_code) -> ReferralResult:
+        self.execute(cursor, 'apply_referral', user_id, referral_code)
+        exists, has_referred, own_code, referrer_id, user_balance, referrer_balance = cursor.fetchone()
+        
+        if not exists:
+            return ReferralResult('not_found')
+        
+        if user_balance is not None:
+            return ReferralResult('ok', referrer_id, referrer_balance, user_balance)
+        
+        if has_referred:
+            return ReferralResult('already_referred')
+        
+        if own_code:
+            return ReferralResult('own_code')
+        
+        if referrer_id is None:
+            return ReferralResult('invalid_code')
+        
+        # A concurrent submission won the row lock and referred this user first
+        return ReferralResult('already_referred')
+
+    def apply_referral(self, user_id, referral_code) -> ReferralResult:
+        with self.transaction() as cursor:
+            result = self._apply_referral(cursor, user_id, referral_code)
+        self._referral_applied(user_id, result)
+        return result
+
+    def finalize_airdrop(self, user_id) -> AirdropResult:
+        with self.transaction() as cursor:
+            user = self._fetch_user(cursor, user_id)
+            
+            if not user:
+                return AirdropResult('not_found')
+            
+            if user.participated:
+                return AirdropResult('already_completed')
+            
+            if not user.bsc_address:
+                return AirdropResult('no_wallet')
+            
+            self.execute(cursor, 'finalize_airdrop', user_id)
+            final_balance = cursor.fetchone()[0]
+            
+            referrer_balance = None
+            if user.referrer_id:
+                self.execute(cursor, 'reward_referrer', user.referrer_id)
+                referrer_balance = cursor.fetchone()[0]
+        
+        self.profiles.update_balance(user_id, final_balance)
+        if user.referrer_id:
+            self.profiles.invalidate(user.referrer_id)
+        return AirdropResult(
+            'ok',
+            bsc_address=user.bsc_address,
+            username=user.username,
+            final_balance=final_balance,
+            referrer_id=user.referrer_id,
+            referrer_balance=referrer_balance
+        )
+
+    def bulk_credit(self, credits) -> 'BulkCreditResult':
+        # credits: [(line, user_id or None, username or None, amount), ...]
+        # Loaded with COPY into a temp table, then applied with one set-based UPDATE
+        credits = [
+            (line, user_id or self.usernames.get(username), username if not user_id else None, amount)
+            for line, user_id, username, amount in credits
+        ]
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(credits)
+        buffer.seek(0)
+        
+        with self.transaction() as cursor:
+            started = time.perf_counter()
+            cursor.execute('''
+                CREATE TEMP TABLE bulk_credits (
+                    line INTEGER NOT NULL,
+                    user_id BIGINT,
+                    username TEXT,
+                    amount INTEGER NOT NULL
+                ) ON COMMIT DROP
+            ''')
+            cursor.copy_expert("COPY bulk_credits FROM STDIN WITH (FORMAT csv)", buffer)
+            cursor.execute('''
+                UPDATE bulk_credits b
+                SET user_id = u.user_id
+                FROM users u
+                WHERE b.user_id IS NULL AND lower(u.username) = lower(b.username)
+                RETURNING b.username, u.user_id
+            ''')
+            for username, user_id in cursor.fetchall():
+                self.usernames.put(username, user_id)
+            cursor.execute('''
+                SELECT b.line, COALESCE('@' || b.username, b.user_id::text)
+                FROM bulk_credits b
+                WHERE NOT EXISTS (SELECT 1 FROM users u WHERE u.user_id = b.user_id)
+                ORDER BY b.line
+            ''')
+            unknown = cursor.fetchall()
+            cursor.execute('''
+                UPDATE users u
+                SET balance = u.balance + c.total,
+                    updated_at = NOW()
+                FROM (
+                    SELECT user_id, SUM(amount) AS total
+                    FROM bulk_credits
+                    WHERE user_id IS NOT NULL
+                    GROUP BY user_id
+                ) c
+                WHERE u.user_id = c.user_id
+                RETURNING u.user_id, c.total, u.balance
+            ''')
+            credited = cursor.fetchall()
+            self._record('bulk_credit', time.perf_counter() - started)
+        for user_id, _, balance in credited:
+            self.profiles.update_balance(user_id, balance)
+        return BulkCreditResult(credited, unknown)
+
+    def find_user_id_by_username(self, username) -> Optional[int]:
+        user_id = self.usernames.get(username)
+        if user_id:
+            return user_id
+        with self.transaction() as cursor:
+            self.execute(cursor, 'find_user_by_username', username)
+            row = cursor.fetchone()
+        if row:
+            self.usernames.put(username, row[0])
+            return row[0]
+        return None
+
+    def credit_balance(self, user_id, amount) -> Optional[int]:
+        with self.transaction() as cursor:
+            self.execute(cursor, 'credit_balance', user_id, amount)
+            row = cursor.fetchone()
+        if not row:
+            return None
+        self.profiles.update_balance(user_id, row[0])
+        return row[0]
+
+    def load_tasks(self):
+        with self.transaction() as cursor:
+            self.execute(cursor, 'load_tasks')
+            return cursor.fetchall()
+
+    def load_user_states(self) -> dict:
+        with self.transaction() as cursor:
+            self.execute(cursor, 'load_user_states')
+            return {user_id: data for user_id, data in cursor.fetchall()}
+
+    def save_user_states(self, states: dict):
+        # states: user_id -> user_data dict, or None to delete the row
+        with self.transaction() as cursor:
+            self.execute_batch(cursor, 'save_user_state', [
+                (user_id, json.dumps(data)) for user_id, data in states.items() if data is not None
+            ])
+            self.execute_batch(cursor, 'delete_user_state', [
+                (user_id,) for user_id, data in states.items() if data is None
+            ])
+
+    def last_wallet_export(self) -> Optional[datetime]:
+        with self.transaction() as cursor:
+            self.execute(cursor, 'last_wallet_export')
+            return cursor.fetchone()[0]
+
+    def wallet_export_snapshot(self) -> datetime:
+        # Backdated a little so writes that were still in flight when the export
+        # started show up in the next delta; duplicates there are harmless
+        with self.transaction() as cursor:
+            self.execute(cursor, 'wallet_export_snapshot')
+            return cursor.fetchone()[0]
+
+    def record_wallet_export(self, exported_at: datetime, row_count: int, delta: bool):
+        with self.transaction() as cursor:
+            self.execute(cursor, 'record_wallet_export', exported_at, row_count, delta)
 
+    def iter_wallet_rows(self, participated_only=False, min_balance=None, created_since=None,
+                         updated_since=None):
+        # Named cursors can't DECLARE over EXECUTE, so this query is not prepared
+        conditions = ['bsc_address IS NOT NULL']
+        params = []
+        if participated_only:
+            conditions.append('participated')
+        if min_balance is not None:
+            conditions.append('balance >= %s')
+            params.append(min_balance)
+        if created_since is not None:
+            conditions.append('created_at >= %s')
+            params.append(created_since)
+        if updated_since is not None:
+            conditions.append('updated_at >= %s')
+            params.append(updated_since)
+        
+        with self.transaction(cursor_name='wallet_export') as cursor:
+            cursor.itersize = EXPORT_FETCH_SIZE
+            started = time.perf_counter()
+            cursor.execute(f'''
+                SELECT user_id, username, bsc_address, balance, referral_code,
+                       referral_count, referral_rewards, created_at
+                FROM users
+                WHERE {' AND '.join(conditions)}
+                ORDER BY created_at DESC
+            ''', params)
+            count = 0
+            for row in cursor:
+                count += 1
+                yield row
+            self._record('wallet_export', time.perf_counter() - started)
+
+    def create_broadcast_job(self, admin_chat_id, message_text, owner):
+        # Snapshots every reachable user as a pending delivery; returns (job_id, total)
+        with self.transaction() as cursor:
+            self.execute(cursor, 'create_broadcast_job', admin_chat_id, message_text, owner)
+            return cursor.fetchone()
+
+    def claim_broadcast_jobs(self, owner, lease):
+        # Running jobs with no live owner; returns [(job_id, admin_chat_id, message_text)]
+        with self.transaction() as cursor:
+            self.execute(cursor, 'claim_broadcast_jobs', owner, lease)
+            return sorted(cursor.fetchall())
+
+    def renew_broadcast_lease(self, job_id, owner) -> bool:
+        with self.transaction() as cursor:
+            self.execute(cursor, 'renew_broadcast_lease', job_id, owner)
+            return cursor.fetchone() is not None
+
+    def release_broadcast_job(self, job_id, owner):
+        with self.transaction() as cursor:
+            self.execute(cursor, 'release_broadcast_job', job_id, owner)
+
+    def delivery_counts(self, job_id) -> dict:
+        with self.transaction() as cursor:
+            self.execute(cursor, 'delivery_counts', job_id)
+            return dict(cursor.fetchall())
+
+    def pending_deliveries(self, job_id, after_id, limit) -> List[int]:
+        with self.transaction() as cursor:
+            self.execute(cursor, 'pending_deliveries', job_id, after_id, limit)
+            return [row[0] for row in cursor.fetchall()]
+
+    def record_deliveries(self, job_id, results):
+        # results: [(user_id, status), ...]
+        with self.transaction() as cursor:
+            user_ids = [user_id for user_id, _ in results]
+            statuses = [status for _, status in results]
+            self.execute(cursor, 'record_deliveries', job_id, user_ids, statuses)
+            blocked = [user_id for user_id, status in results if status == 'blocked']
+            if blocked:
+                self.execute(cursor, 'mark_blocked', blocked)
+
+    def finish_broadcast_job(self, job_id, status):
+        with self.transaction() as cursor:
+            self.execute(cursor, 'finish_broadcast_job', job_id, status)
+
+@timed
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     logger.info(f"/start command from {user.id} ({user.username})")
@@ -133,22 +1510,27 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⚠️ System initializing, try again soon.")
         return
     
-    conn = None
-    cursor = None
+    # t.me/<bot>?start=<CODE> deep links arrive as /start <CODE>
+    start_referral_code = None
+    if context.args:
+        payload = context.args[0].strip().upper()
+        if re.match(r'^[A-Z0-9]{1,10}$', payload):
+            start_referral_code = payload
+        else:
+            logger.info(f"Ignoring /start payload from {user.id}: {context.args[0]}")
+    
     try:
-        conn = db_pool.getconn()
-        cursor = conn.cursor()
+        result = await run_db(user_repository.register_user, user.id, user.username, start_referral_code)
+        user_data = result.user
         
-        cursor.execute("SELECT participated, current_task, referral_code, balance FROM users WHERE user_id = %s", (user.id,))
-        user_data = cursor.fetchone()
+        if result.referral:
+            await reply_start_referral(update, context, result.referral)
         
-        if user_data and user_data[0]:  # Airdrop tamamlanmış
-            balance = user_data[3]
-            referral_code = user_data[2]
+        if user_data.participated:  # Airdrop tamamlanmış
             message = (
                 f"🎉 Airdrop already completed!\n\n"
-                f"💰 Your Balance: {balance} Solium\n"
-                f"🔗 Your Referral Code: {referral_code}\n\n"
+                f"💰 Your Balance: {user_data.balance} Solium\n"
+                f"🔗 Your Referral Code: {user_data.referral_code}\n\n"
                 f"Use the buttons below to check your balance or enter a referral code."
             )
             keyboard = [
@@ -163,141 +1545,99 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 disable_web_page_preview=True
             )
             return
-            
-        if user_data and not user_data[2]:
-            referral_code = generate_referral_code()
-            cursor.execute('''
-                UPDATE users 
-                SET referral_code = %s,
-                    updated_at = NOW()
-                WHERE user_id = %s
-            ''', (referral_code, user.id))
-        
-        if not user_data:
-            referral_code = generate_referral_code()
-            cursor.execute('''
-                INSERT INTO users (user_id, username, referral_code)
-                VALUES (%s, %s, %s)
-                RETURNING current_task
-            ''', (user.id, user.username, referral_code))
-        else:
-            cursor.execute('''
-                UPDATE users 
-                SET username = %s,
-                    updated_at = NOW()
-                WHERE user_id = %s
-                RETURNING current_task
-            ''', (user.username, user.id))
-        
-        current_task = cursor.fetchone()[0]
-        conn.commit()
         
-        if not user_data or not user_data[2]:
+        if result.new_referral_code:
             await update.message.reply_text(
-                f"🎉 Your unique referral code: {referral_code}\n\n"
-                f"Share this code to earn more rewards!"
+                f"🎉 Your unique referral code: {result.new_referral_code}\n\n"
+                f"Share this code to earn more rewards!\n"
+                f"🔗 https://t.me/{context.bot.username}?start={result.new_referral_code}",
+                disable_web_page_preview=True
             )
         
-        await show_task(update, context, current_task)
+        await show_task(update, context, user_data.current_task)
         
     except Exception as e:
         logger.error(f"Start command error: {e}", exc_info=True)
         await update.message.reply_text("❌ System error. Try again.")
-        if conn:
-            conn.rollback()
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            db_pool.putconn(conn)
 
+@dataclass(frozen=True)
+class TaskView:
+    number: int
+    reward: int
+    kind: str  # visit: done when opened with Next; wallet: done by submitting a BSC address
+    text: str
+    keyboard: InlineKeyboardMarkup
+
+class TaskCatalog:
+    # Task messages and keyboards rendered once per load, so showing a task is a dict lookup
+    def __init__(self, rows):
+        total = len(rows)
+        self.tasks = {}
+        self.wallet_task = None
+        for number, title, description, reward, button_text, button_callback, kind in rows:
+            keyboard = []
+            
+            if button_text and button_callback:
+                keyboard.append([InlineKeyboardButton(button_text, callback_data=button_callback)])
+            
+            keyboard.append([
+                InlineKeyboardButton("💰 Balance", callback_data='show_balance'),
+                InlineKeyboardButton("🤝 Referral", callback_data='enter_referral')
+            ])
+            
+            # Sadece Next butonu
+            if number < total:
+                keyboard.append([InlineKeyboardButton("Next ▶️", callback_data=f'show_task_{number+1}')])
+            
+            text = (
+                f"🎯 Task {number}/{total}\n\n"
+                f"{title}\n\n"
+                f"{description}\n\n"
+                f"Reward: +{reward} Solium"
+            )
+            self.tasks[number] = TaskView(number, reward, kind, text, InlineKeyboardMarkup(keyboard))
+            if kind == 'wallet':
+                self.wallet_task = self.tasks[number]
+        
+        # Saving the wallet completes the airdrop, so no task may come after it
+        if rows and (self.wallet_task is None or self.wallet_task.number != max(self.tasks)):
+            raise ValueError("The wallet task must be the last task")
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def get(self, task_number: int) -> Optional[TaskView]:
+        return self.tasks.get(task_number)
+
+task_catalog = TaskCatalog([])
+
+async def load_task_catalog():
+    global task_catalog
+    task_catalog = TaskCatalog(await run_db(user_repository.load_tasks))
+    logger.info(f"Task catalog loaded with {len(task_catalog)} tasks")
+
+@timed
 async def show_task(update: Update, context: ContextTypes.DEFAULT_TYPE, task_number: int):
     user = update.effective_user
     logger.info(f"Showing task {task_number} for {user.id}")
     
-    tasks = [
-        {
-            'title': "1️⃣ Join Our Telegram Group",
-            'description': (
-                "Join the official Solium Telegram group @soliumcoinchat to stay updated on project announcements and community events.\n\n"
-                "<a href='https://t.me/soliumcoinchat'>Click here to join</a>"
-            ),
-            'reward': 20
-        },
-        {
-            'title': "2️⃣ Follow Our Telegram Channel",
-            'description': (
-                "Follow the Solium Telegram channel for the latest news and updates.\n\n"
-                "<a href='https://t.me/soliumcoin'>Click here to follow</a>"
-            ),
-            'reward': 20
-        },
-        {
-            'title': "3️⃣ Follow Solium on X",
-            'description': (
-                "Follow our official X account (@soliumcoin) to get real-time updates.\n\n"
-                "<a href='https://x.com/soliumcoin'>Click here to follow</a>"
-            ),
-            'reward': 20
-        },
-        {
-            'title': "4️⃣ Retweet Our Pinned Post",
-            'description': (
-                "Retweet the pinned post on our X account to spread the word about Solium.\n\n"
-                "<a href='https://x.com/soliumcoin'>Click here to retweet</a>"
-            ),
-            'reward': 20
-        },
-        {
-            'title': "5️⃣ Enter Your BSC Wallet",
-            'description': (
-                "Provide your Binance Smart Chain (BSC) wallet address to receive your Solium rewards.\n\n"
-                "Click the 'Enter Address' button below and send your wallet address (e.g., 0x...)."
-            ),
-            'reward': 20,
-            'button': "Enter Address",
-            'callback': "task_5_wallet"
-        }
-    ]
-    
-    if task_number > len(tasks):
+    task = task_catalog.get(task_number)
+    if task is None:
         await complete_airdrop(update, context)
         return
     
-    task = tasks[task_number-1]
-    keyboard = []
-    
-    if task_number == 5:
-        keyboard.append([InlineKeyboardButton(task['button'], callback_data=task['callback'])])
-    
-    keyboard.append([
-        InlineKeyboardButton("💰 Balance", callback_data='show_balance'),
-        InlineKeyboardButton("🤝 Referral", callback_data='enter_referral')
-    ])
-    
-    # Sadece Next butonu
-    if task_number < len(tasks):
-        keyboard.append([InlineKeyboardButton("Next ▶️", callback_data=f'show_task_{task_number+1}')])
-    
-    message_text = (
-        f"🎯 Task {task_number}/{len(tasks)}\n\n"
-        f"{task['title']}\n\n"
-        f"{task['description']}\n\n"
-        f"Reward: +{task['reward']} Solium"
-    )
-    
     try:
         if update.callback_query:
             await update.callback_query.edit_message_text(
-                text=message_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                text=task.text,
+                reply_markup=task.keyboard,
                 parse_mode='HTML',  # HTML için
                 disable_web_page_preview=True
             )
         else:
             await update.message.reply_text(
-                text=message_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                text=task.text,
+                reply_markup=task.keyboard,
                 parse_mode='HTML',  # HTML için
                 disable_web_page_preview=True
             )
@@ -305,11 +1645,13 @@ async def show_task(update: Update, context: ContextTypes.DEFAULT_TYPE, task_num
         logger.error(f"Error showing task: {e}", exc_info=True)
         await context.bot.send_message(
             chat_id=user.id,
-            text=message_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            text=task.text,
+            reply_markup=task.keyboard,
             parse_mode='HTML',  # HTML için
             disable_web_page_preview=True
         )
+
+@timed
 async def handle_task_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -331,7 +1673,7 @@ async def handle_task_button(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await show_user_balance(update, context, query)
         return
     
-    if data == 'task_5_wallet':
+    if data.startswith('task_') and data.endswith('_wallet'):
         context.user_data['awaiting_wallet'] = True
         await query.edit_message_text(
             "💰 Please send your BSC wallet address:\n\n"
@@ -343,78 +1685,49 @@ async def handle_task_button(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if data.startswith('show_task_'):
         try:
             task_number = int(data.split('_')[2])
-            conn = None
-            cursor = None
             try:
-                conn = db_pool.getconn()
-                cursor = conn.cursor()
-                
-                if task_number <= 4:
-                    task_column = f'task{task_number}_completed'
-                    cursor.execute(f'''
-                        UPDATE users 
-                        SET {task_column} = TRUE,
-                            balance = balance + 20,
-                            current_task = %s,
-                            updated_at = NOW()
-                        WHERE user_id = %s
-                        RETURNING balance
-                    ''', (task_number + 1, user.id))
-                    
-                    new_balance = cursor.fetchone()[0]
-                    conn.commit()
-                    logger.info(f"Task {task_number} marked complete for user {user.id}, balance: {new_balance}")
+                # Opening a visit task via Next completes it (the first task is shown by /start
+                # and never credited); wallet tasks complete when the address is saved
+                task = task_catalog.get(task_number)
+                if task and task.kind == 'visit' and not completed_tasks.contains(user.id, task.number):
+                    result = await run_db(user_repository.complete_task, user.id, task.number, task.reward)
+                    if result:
+                        completed_tasks.add(user.id, task.number)
+                    if result and result.credited:
+                        logger.info(f"Task {task.number} marked complete for user {user.id}, balance: {result.balance}")
                 
                 await show_task(update, context, task_number)
                 
             except Exception as e:
                 logger.error(f"Task update error for user_id {user.id}, task {task_number}: {e}", exc_info=True)
                 await query.edit_message_text("❌ System error. Try again.")
-                if conn:
-                    conn.rollback()
-            finally:
-                if cursor:
-                    cursor.close()
-                if conn:
-                    db_pool.putconn(conn)
         except (IndexError, ValueError) as e:
             logger.error(f"Invalid task navigation data: {data}, error: {e}")
             await query.edit_message_text("❌ Invalid task navigation. Try again.")
 
+@timed
 async def show_user_balance(update: Update, context: ContextTypes.DEFAULT_TYPE, query):
     user = query.from_user
     
     logger.info(f"Showing balance for user {user.id}")
     
-    conn = None
-    cursor = None
     try:
-        conn = db_pool.getconn()
-        cursor = conn.cursor()
+        # Cache hits are answered without leaving the event loop
+        profile = user_repository.profiles.get(user.id) or await run_db(user_repository.get_profile, user.id)
         
-        cursor.execute('''
-            SELECT balance, referral_code, referral_count, referral_rewards 
-            FROM users 
-            WHERE user_id = %s
-        ''', (user.id,))
-        
-        user_data = cursor.fetchone()
-        
-        if not user_data:
+        if not profile:
             logger.warning(f"User {user.id} not found in database")
             await query.edit_message_text("❌ User not found. Use /start first.")
             return
         
-        balance, referral_code, referral_count, referral_rewards = user_data
-        
         message = (
-            f"💰 Balance: {balance} Solium\n"
-            f"🔗 Ref Code: {referral_code}\n"
-            f"👥 Referrals: {referral_count}\n"
-            f"🎁 Rewards: {referral_rewards} Solium"
+            f"💰 Balance: {profile.balance} Solium\n"
+            f"🔗 Ref Code: {profile.referral_code}\n"
+            f"👥 Referrals: {profile.referral_count}\n"
+            f"🎁 Rewards: {profile.referral_rewards} Solium"
         )
         
-        logger.info(f"Balance shown for user {user.id}: {balance} Solium")
+        logger.info(f"Balance shown for user {user.id}: {profile.balance} Solium")
         
         await query.edit_message_text(
             text=message,
@@ -424,12 +1737,8 @@ async def show_user_balance(update: Update, context: ContextTypes.DEFAULT_TYPE,
     except Exception as e:
         logger.error(f"Balance check error for user_id {user.id}: {e}", exc_info=True)
         await query.answer("❌ Error showing balance", show_alert=True)
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            db_pool.putconn(conn)
 
+@timed
 async def handle_wallet_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     wallet_address = update.message.text.strip()
@@ -446,36 +1755,25 @@ async def handle_wallet_address(update: Update, context: ContextTypes.DEFAULT_TY
         )
         return
     
-    conn = None
-    cursor = None
+    wallet_task = task_catalog.wallet_task
+    if not wallet_task:
+        logger.error("Task catalog has no wallet task")
+        await update.message.reply_text("❌ Failed to save wallet. Try again.")
+        return
+    
     try:
-        conn = db_pool.getconn()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            UPDATE users 
-            SET bsc_address = %s,
-                task5_completed = TRUE,
-                balance = balance + 20,
-                current_task = 6,
-                updated_at = NOW()
-            WHERE user_id = %s
-            RETURNING balance
-        ''', (wallet_address, user.id))
-        
-        result = cursor.fetchone()
-        if not result:
+        result = await run_db(user_repository.save_wallet, user.id, wallet_address, wallet_task.number, wallet_task.reward)
+        if result is None:
             logger.error(f"Wallet update failed for user {user.id}: No rows affected")
             await update.message.reply_text("❌ Failed to save wallet. Try again.")
             return
         
-        new_balance = result[0]
-        conn.commit()
-        logger.info(f"Wallet saved for user {user.id}, balance: {new_balance}")
+        logger.info(f"Wallet saved for user {user.id}, balance: {result.balance}")
         
         context.user_data['awaiting_wallet'] = False
+        reward_line = f"+{result.credited} Solium added!\n" if result.credited else ""
         await update.message.reply_text(
-            f"✅ Wallet address saved!\n+20 Solium added!\n\n💰 Balance: {new_balance} Solium\n\nCompleting airdrop..."
+            f"✅ Wallet address saved!\n{reward_line}\n💰 Balance: {result.balance} Solium\n\nCompleting airdrop..."
         )
         
         await complete_airdrop(update, context)
@@ -483,14 +1781,8 @@ async def handle_wallet_address(update: Update, context: ContextTypes.DEFAULT_TY
     except Exception as e:
         logger.error(f"Wallet save error for user_id {user.id}: {e}", exc_info=True)
         await update.message.reply_text(f"❌ System error saving wallet: {str(e)}")
-        if conn:
-            conn.rollback()
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            db_pool.putconn(conn)
 
+@timed
 async def handle_referral_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     referral_code = update.message.text.strip().upper()
@@ -501,175 +1793,98 @@ async def handle_referral_code(update: Update, context: ContextTypes.DEFAULT_TYP
     
     logger.info(f"Processing referral code for user {user.id}: {referral_code}")
     
-    conn = None
-    cursor = None
     try:
-        conn = db_pool.getconn()
-        cursor = conn.cursor()
+        result = await run_db(user_repository.apply_referral, user.id, referral_code)
+        status = result.status
         
-        cursor.execute('''
-            SELECT has_referred, participated, referral_code 
-            FROM users 
-            WHERE user_id = %s
-        ''', (user.id,))
-        user_data = cursor.fetchone()
-        
-        if not user_data:
+        if status == 'not_found':
             await update.message.reply_text("❌ User not found. Use /start.")
             return
             
-        has_referred, participated, user_referral_code = user_data
-        
-        if has_referred:
+        if status == 'already_referred':
             await update.message.reply_text("❌ You've already used a referral code!")
             return
             
-        #if participated:
-            #await update.message.reply_text("❌ Airdrop completed, can't use referral code!")
-            #return
-            
-        if referral_code == user_referral_code:
+        if status == 'own_code':
             await update.message.reply_text("❌ You can't use your own referral code!")
             return
         
-        cursor.execute('''
-            SELECT user_id 
-            FROM users 
-            WHERE referral_code = %s
-        ''', (referral_code,))  # username kaldirildi
-        referrer_data = cursor.fetchone()
-        
-        if not referrer_data:
+        if status == 'invalid_code':
             await update.message.reply_text("❌ Invalid referral code!")
             return
-            
-        referrer_id = referrer_data[0]
-        
-        # Update referrer's balance and stats
-        cursor.execute('''
-            UPDATE users 
-            SET 
-                referrals = referrals + 1,
-                referral_count = referral_count + 1,
-                balance = balance + 20,
-                referral_rewards = referral_rewards + 20,
-                updated_at = NOW()
-            WHERE user_id = %s
-            RETURNING balance
-        ''', (referrer_id,))
-        referrer_new_balance = cursor.fetchone()[0]
-        
-        # Update user's balance and stats
-        cursor.execute('''
-            UPDATE users 
-            SET 
-                referrer_id = %s,
-                has_referred = TRUE,
-                balance = balance + 20,
-                updated_at = NOW()
-            WHERE user_id = %s
-            RETURNING balance
-        ''', (referrer_id, user.id))
-        user_new_balance = cursor.fetchone()[0]
-        
-        conn.commit()
         
         context.user_data['awaiting_referral'] = False
         
         await update.message.reply_text(
             f"✅ Referral code accepted!\n\n"
             f"💰 +20 Solium added to your balance!\n"
-            f"💵 Your new balance: {user_new_balance} Solium"
+            f"💵 Your new balance: {result.user_balance} Solium"
             # Referred by kismi tamamen kaldirildi
         )
         
-        try:
-            await context.bot.send_message(
-                chat_id=referrer_id,
-                text=f"🎉 New referral!\n\n"
-                     f"A user used your referral code.\n"
-                     f"💰 +20 Solium added to your balance!\n"
-                     f"💵 Your new balance: {referrer_new_balance} Solium"
-            )
-        except Exception as e:
-            logger.warning(f"Failed to notify referrer {referrer_id}: {e}")
+        notify_referrer(result)
         
     except Exception as e:
         logger.error(f"Referral code error for user_id {user.id}: {e}", exc_info=True)
         await update.message.reply_text("❌ System error processing referral code. Try again.")
-        if conn:
-            conn.rollback()
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            db_pool.putconn(conn)
 
+def notify_referrer(result: ReferralResult):
+    notification_queue.enqueue(
+        result.referrer_id,
+        f"🎉 New referral!\n\n"
+        f"A user used your referral code.\n"
+        f"💰 +20 Solium added to your balance!\n"
+        f"💵 Your new balance: {result.referrer_balance} Solium"
+    )
+
+async def reply_start_referral(update: Update, context: ContextTypes.DEFAULT_TYPE, result: ReferralResult):
+    # Deep-link referrals; already_referred stays silent so returning users can reuse old links
+    if result.status == 'ok':
+        logger.info(f"Deep-link referral applied for {update.effective_user.id}, referrer {result.referrer_id}")
+        await update.message.reply_text(
+            f"✅ Referral code accepted!\n\n"
+            f"💰 +20 Solium added to your balance!\n"
+            f"💵 Your new balance: {result.user_balance} Solium"
+        )
+        notify_referrer(result)
+    elif result.status == 'own_code':
+        await update.message.reply_text("❌ You can't use your own referral code!")
+    elif result.status == 'invalid_code':
+        await update.message.reply_text("❌ Invalid referral code!")
+
+@timed
 async def complete_airdrop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
-    conn = None
-    cursor = None
     try:
-        conn = db_pool.getconn()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT participated, bsc_address, referrer_id, username 
-            FROM users 
-            WHERE user_id = %s
-        ''', (user.id,))  # username eklendi
-        user_data = cursor.fetchone()
+        result = await run_db(user_repository.finalize_airdrop, user.id)
+        status = result.status
         
-        if not user_data:
+        if status == 'not_found':
             await update.message.reply_text("❌ User not found. Use /start.")
             return
             
-        participated, bsc_address, referrer_id, username = user_data
-        
-        if participated:
+        if status == 'already_completed':
             await update.message.reply_text("🎉 Airdrop already completed!")
             return
             
-        if not bsc_address:
-            await update.message.reply_text("❌ No wallet address provided. Complete Task 5.")
+        if status == 'no_wallet':
+            wallet_number = task_catalog.wallet_task.number if task_catalog.wallet_task else len(task_catalog)
+            await update.message.reply_text(f"❌ No wallet address provided. Complete Task {wallet_number}.")
             return
         
-        cursor.execute('''
-            UPDATE users 
-            SET 
-                participated = TRUE,
-                balance = balance + 100,
-                updated_at = NOW()
-            WHERE user_id = %s
-            RETURNING balance
-        ''', (user.id,))
-        final_balance = cursor.fetchone()[0]
+        bsc_address = result.bsc_address
+        referrer_id = result.referrer_id
+        final_balance = result.final_balance
         
+        # Queued after commit; the background sender delivers them without blocking this update
         if referrer_id:
-            cursor.execute('''
-                UPDATE users 
-                SET 
-                    balance = balance + 20,
-                    referral_rewards = referral_rewards + 20,
-                    updated_at = NOW()
-                WHERE user_id = %s
-                RETURNING balance
-            ''', (referrer_id,))
-            referrer_data = cursor.fetchone()
-            referrer_new_balance = referrer_data[0]
-            
-            try:
-                await context.bot.send_message(
-                    chat_id=referrer_id,
-                    text=f"🎉 Your referral completed the airdrop!\n\n"
-                         f"💰 +20 Solium added to your balance!\n"
-                         f"💵 Your new balance: {referrer_new_balance} Solium"
-                )
-            except Exception as e:
-                logger.warning(f"Couldn't notify referrer: {e}")
-        
-        conn.commit()
+            notification_queue.enqueue(
+                referrer_id,
+                f"🎉 Your referral completed the airdrop!\n\n"
+                f"💰 +20 Solium added to your balance!\n"
+                f"💵 Your new balance: {result.referrer_balance} Solium"
+            )
         
         completion_text = (
             f"🎉 AIRDROP COMPLETED!\n\n"
@@ -684,61 +1899,146 @@ async def complete_airdrop(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await update.message.reply_text(completion_text)
         
-        try:
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=f"🚀 New airdrop completion:\n\n"
-                     f"User: @{username or 'Unknown'}\n"
-                     f"User ID: {user.id}\n"
-                     f"Wallet: {bsc_address}\n"
-                     f"Balance: {final_balance} Solium\n"
-                     f"Referrer: {'User ' + str(referrer_id) if referrer_id else 'None'}"
-            )
-        except Exception as e:
-            logger.error(f"Admin notification failed: {e}")
+        notification_queue.enqueue(
+            ADMIN_ID,
+            f"🚀 New airdrop completion:\n\n"
+            f"User: @{result.username or 'Unknown'}\n"
+            f"User ID: {user.id}\n"
+            f"Wallet: {bsc_address}\n"
+            f"Balance: {final_balance} Solium\n"
+            f"Referrer: {'User ' + str(referrer_id) if referrer_id else 'None'}"
+        )
             
     except Exception as e:
         logger.error(f"Airdrop completion error for user_id {user.id}: {e}", exc_info=True)
         await update.message.reply_text("❌ System error during completion. Try again.")
-        if conn:
-            conn.rollback()
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            db_pool.putconn(conn)
 
-async def export_wallets(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("❌ Admin access required!")
-        return
-        
-    logger.info("Admin requested wallet export")
-    
-    conn = None
-    cursor = None
+@dataclass
+class ExportOptions:
+    format: str = 'json'  # json, csv, ndjson
+    compress: bool = False
+    participated_only: bool = False
+    min_balance: Optional[int] = None
+    created_since: Optional[datetime] = None
+    changed_only: bool = False  # rows updated since the last unfiltered export
+
+    @classmethod
+    def parse(cls, args) -> 'ExportOptions':
+        # e.g. /export_wallets csv gz participated min=100 since=2024-01-01
+        options = cls()
+        for arg in args:
+            arg = arg.lower()
+            if arg in EXPORT_FORMATS:
+                options.format = arg
+            elif arg in ('gz', 'gzip'):
+                options.compress = True
+            elif arg == 'participated':
+                options.participated_only = True
+            elif arg in ('changed', 'delta'):
+                options.changed_only = True
+            elif arg.startswith('min='):
+                options.min_balance = int(arg[4:])
+            elif arg.startswith('since='):
+                options.created_since = datetime.strptime(arg[6:], '%Y-%m-%d')
+            else:
+                raise ValueError(f"Unknown option: {arg}")
+        return options
+
+    @property
+    def filtered(self) -> bool:
+        return self.participated_only or self.min_balance is not None or self.created_since is not None
+
+    @property
+    def extension(self) -> str:
+        return self.format + ('.gz' if self.compress else '')
+
+EXPORT_FORMATS = ('json', 'csv', 'ndjson')
+EXPORT_COLUMNS = (
+    'user_id', 'username', 'wallet_address', 'balance',
+    'referral_code', 'referral_count', 'referral_rewards', 'registration_date'
+)
+
+class WalletExportWriter:
+    # Encodes rows in the requested format into spooled chunks, starting a new
+    # chunk (with its own JSON brackets / CSV header) once one reaches chunk_size
+    def __init__(self, options: ExportOptions, chunk_size: int):
+        self.options = options
+        self.chunk_size = chunk_size
+        self.chunks = []  # [(buffer, row_count)]
+        self.count = 0
+        self._buffer = None
+        self._stream = None
+        self._chunk_rows = 0
+        self._line = io.StringIO()
+        self._csv = csv.writer(self._line)
+
+    def _open_chunk(self):
+        self._buffer = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+        self._stream = gzip.GzipFile(fileobj=self._buffer, mode='wb') if self.options.compress else self._buffer
+        self._chunk_rows = 0
+        if self.options.format == 'json':
+            self._stream.write(b'[')
+        elif self.options.format == 'csv':
+            self._stream.write(self._csv_line(EXPORT_COLUMNS))
+
+    def _close_chunk(self):
+        if self.options.format == 'json':
+            self._stream.write(b']')
+        if self.options.compress:
+            self._stream.close()
+        self._buffer.seek(0)
+        self.chunks.append((self._buffer, self._chunk_rows))
+        self._buffer = self._stream = None
+
+    def _csv_line(self, values) -> bytes:
+        self._line.seek(0)
+        self._line.truncate()
+        self._csv.writerow(values)
+        return self._line.getvalue().encode('utf-8')
+
+    def _encode(self, record: dict) -> bytes:
+        if self.options.format == 'csv':
+            return self._csv_line([record[column] for column in EXPORT_COLUMNS])
+        data = json.dumps(record, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        if self.options.format == 'ndjson':
+            return data + b'\n'
+        return data if not self._chunk_rows else b',' + data
+
+    def write(self, record: dict):
+        if self._buffer is not None and self._buffer.tell() >= self.chunk_size:
+            self._close_chunk()
+        if self._buffer is None:
+            self._open_chunk()
+        self._stream.write(self._encode(record))
+        self._chunk_rows += 1
+        self.count += 1
+
+    def close(self):
+        if self._buffer is not None:
+            self._close_chunk()
+        return self.chunks
+
+    def discard(self):
+        for buffer, _ in self.chunks:
+            buffer.close()
+        if self._buffer is not None:
+            self._buffer.close()
+
+def write_wallet_export(options: ExportOptions):
+    # Streams rows from the server-side cursor into size-capped chunks
+    writer = WalletExportWriter(options, EXPORT_CHUNK_SIZE)
     try:
-        conn = db_pool.getconn()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT 
-                user_id, 
-                username, 
-                bsc_address, 
-                balance, 
-                referral_code,
-                referral_count,
-                referral_rewards,
-                created_at 
-            FROM users 
-            WHERE bsc_address IS NOT NULL
-            ORDER BY created_at DESC
-        ''')
-        
-        wallets = []
-        for row in cursor.fetchall():
-            wallets.append({
+        # Without a previous export, a delta is the full export
+        updated_since = user_repository.last_wallet_export() if options.changed_only else None
+        snapshot_at = user_repository.wallet_export_snapshot()
+        rows = user_repository.iter_wallet_rows(
+            participated_only=options.participated_only,
+            min_balance=options.min_balance,
+            created_since=options.created_since,
+            updated_since=updated_since
+        )
+        for row in rows:
+            writer.write({
                 'user_id': row[0],
                 'username': row[1] or 'no_username',
                 'wallet_address': row[2],
@@ -748,35 +2048,518 @@ async def export_wallets(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 'referral_rewards': row[6],
                 'registration_date': row[7].isoformat()
             })
+        writer.close()
+    except Exception:
+        writer.discard()
+        raise
+    return writer, snapshot_at, updated_since is not None
+
+async def send_wallet_export(update: Update, caption: str, options: Optional[ExportOptions] = None) -> int:
+    # Small chunks stay in memory; large ones spill to the system temp dir and are removed on close
+    options = options or ExportOptions()
+    writer, snapshot_at, delta = await run_db(write_wallet_export, options)
+    try:
+        parts = len(writer.chunks)
+        for part, (buffer, rows) in enumerate(writer.chunks, start=1):
+            suffix = f"_part{part}of{parts}" if parts > 1 else ''
+            await update.message.reply_document(
+                document=buffer,
+                caption=caption.format(count=writer.count) + (f" (part {part}/{parts}, {rows} rows)" if parts > 1 else ''),
+                filename=f"solium_wallets_{writer.count}{suffix}.{options.extension}"
+            )
+    finally:
+        writer.discard()
+    # Only mark the export once every chunk reached the admin, otherwise the
+    # next delta would skip the rows of a failed upload
+    if not options.filtered:
+        await run_db(user_repository.record_wallet_export, snapshot_at, writer.count, delta)
+    return writer.count
+
+@timed
+async def export_wallets(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Admin access required!")
+        return
+    
+    try:
+        options = ExportOptions.parse(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(
+            f"❌ Invalid option: {e}\n"
+            f"Usage: /export_wallets [json|csv|ndjson] [gz] [changed] [participated] [min=<balance>] [since=YYYY-MM-DD]"
+        )
+        return
         
-        if not wallets:
-            await update.message.reply_text("❌ No wallet addresses found!")
-            return
-            
-        filename = f"solium_wallets_{len(wallets)}.json"
-        with open(filename, 'w') as f:
-            json.dump(wallets, f, indent=2, ensure_ascii=False)
+    logger.info(f"Admin requested wallet export: {options}")
+    
+    try:
+        count = await send_wallet_export(update, "📊 Exported {count} wallets", options)
         
-        with open(filename, 'rb') as f:
-            await update.message.reply_document(
-                document=f,
-                caption=f"📊 Exported {len(wallets)} wallets",
-                filename=filename
+        if not count:
+            await update.message.reply_text(
+                "✅ No wallet changes since the last export." if options.changed_only else "❌ No wallet addresses found!"
             )
+            return
         
-        os.remove(filename)
-        logger.info(f"Exported {len(wallets)} wallets")
+        logger.info(f"Exported {count} wallets")
         
     except Exception as e:
         logger.error(f"Wallet export error: {e}", exc_info=True)
         await update.message.reply_text("❌ Export failed. Check logs.")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            db_pool.putconn(conn)
 
 
+class TokenBucket:
+    # Async token bucket; callers reserve a slot and sleep until it is due, so no lock is needed
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        self._refill()
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self._tokens >= self.capacity
+
+    def try_acquire(self) -> bool:
+        # Non-blocking variant: take a token if one is available right now
+        self._refill()
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def pause(self, seconds: float):
+        # Push every pending and future caller back by at least `seconds` (RetryAfter)
+        self._refill()
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+class Broadcast:
+    # Delivery state lives in broadcast_deliveries, so a job interrupted by a restart
+    # resumes with the users still pending. Results are flushed in batches; a crash
+    # between a send and its flush can resend to at most one batch of users. Only the
+    # process holding a job's lease sends it.
+    active = {}  # job_id -> Broadcast
+    watcher = None
+
+    def __init__(self, bot, job_id: int, admin_chat_id: int, text: str):
+        self.bot = bot
+        self.job_id = job_id
+        self.admin_chat_id = admin_chat_id
+        self.text = text
+        self.limiter = TokenBucket(BROADCAST_RATE)
+        self.total = 0
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.started = None
+        self.task = None
+        self.done = asyncio.Event()
+        self._results = []
+        self._progress_message = None
+        self._progress_text = None
+
+    @classmethod
+    async def create(cls, bot, admin_chat_id: int, text: str):
+        job_id, total = await run_db(user_repository.create_broadcast_job, admin_chat_id, text, PROCESS_ID)
+        logger.info(f"Broadcast job {job_id} created for {total} users")
+        return cls(bot, job_id, admin_chat_id, text)
+
+    @classmethod
+    async def resume_all(cls, bot):
+        for job_id, admin_chat_id, text in await run_db(user_repository.claim_broadcast_jobs, PROCESS_ID, BROADCAST_LEASE):
+            if job_id in cls.active:
+                continue
+            logger.info(f"Resuming broadcast job {job_id}")
+            cls(bot, job_id, admin_chat_id, text).start(resumed=True)
+
+    @classmethod
+    def watch(cls, bot):
+        # Picks up jobs released by a stopping process or orphaned by a dead one
+        async def loop():
+            while True:
+                try:
+                    await cls.resume_all(bot)
+                except Exception as e:
+                    logger.warning(f"Couldn't claim broadcast jobs: {e}")
+                await asyncio.sleep(BROADCAST_LEASE / 2)
+        cls.watcher = asyncio.create_task(loop())
+
+    @classmethod
+    async def stop_all(cls):
+        # Cancelled jobs flush what they delivered, release their lease and stay
+        # 'running' for another process (or the next boot) to resume
+        if cls.watcher:
+            cls.watcher.cancel()
+            await asyncio.gather(cls.watcher, return_exceptions=True)
+        tasks = [broadcast.task for broadcast in cls.active.values() if broadcast.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    def start(self, resumed=False):
+        Broadcast.active[self.job_id] = self
+        self.task = asyncio.create_task(self.run(resumed))
+        self.task.add_done_callback(lambda _: Broadcast.active.pop(self.job_id, None))
+        return self.task
+
+    async def run(self, resumed=False):
+        self.started = time.monotonic()
+        try:
+            counts = await run_db(user_repository.delivery_counts, self.job_id)
+            self.total = sum(counts.values())
+            self.sent = counts.get('sent', 0)
+            self.failed = counts.get('failed', 0)
+            self.blocked = counts.get('blocked', 0)
+            
+            if not self.total:
+                await run_db(user_repository.finish_broadcast_job, self.job_id, 'completed')
+                await self.bot.send_message(chat_id=self.admin_chat_id, text="❌ No users found in database!")
+                logger.info("No users to send message to")
+                return
+            
+            self._progress_message = await self.bot.send_message(
+                chat_id=self.admin_chat_id,
+                text=self._progress(resumed=resumed)
+            )
+            reporter = asyncio.create_task(self._report_progress())
+            
+            queue = asyncio.Queue(maxsize=BROADCAST_WORKERS * 50)
+            workers = [asyncio.create_task(self._worker(queue)) for _ in range(BROADCAST_WORKERS)]
+            try:
+                # Page through pending deliveries so no DB connection is held while sending
+                after_id = 0
+                while True:
+                    user_ids = await run_db(user_repository.pending_deliveries, self.job_id, after_id, BROADCAST_PAGE_SIZE)
+                    if not user_ids:
+                        break
+                    for user_id in user_ids:
+                        await queue.put(user_id)
+                    after_id = user_ids[-1]
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                self.done.set()
+                reporter.cancel()
+                await self._flush()
+            
+            await run_db(user_repository.finish_broadcast_job, self.job_id, 'completed')
+            await self._update_progress(final=True)
+            logger.info(f"Broadcast job {self.job_id} completed: {self.sent} sent, {self.failed} failed, {self.blocked} blocked")
+        except asyncio.CancelledError:
+            logger.info(f"Broadcast job {self.job_id} interrupted after {self.processed}/{self.total} users")
+            try:
+                await run_db(user_repository.release_broadcast_job, self.job_id, PROCESS_ID)
+            except Exception as e:
+                logger.warning(f"Couldn't release broadcast job {self.job_id}: {e}")
+            raise
+        except Exception as e:
+            logger.error(f"Message broadcast error in job {self.job_id}: {e}", exc_info=True)
+            await run_db(user_repository.finish_broadcast_job, self.job_id, 'failed')
+            await self.bot.send_message(
+                chat_id=self.admin_chat_id,
+                text=f"❌ Broadcast #{self.job_id} stopped after {self.processed} users. Check logs."
+            )
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            user_id = await queue.get()
+            if user_id is None:
+                return
+            self._results.append((user_id, await self._deliver(user_id)))
+            if len(self._results) >= BROADCAST_FLUSH_SIZE:
+                await self._flush()
+
+    async def _flush(self):
+        results, self._results = self._results, []
+        if results:
+            await run_db(user_repository.record_deliveries, self.job_id, results)
+
+    async def _deliver(self, user_id: int) -> str:
+        await self.limiter.acquire()
+        try:
+            # RetryAfter and network errors are retried by OutboundRateLimiter
+            await self.bot.send_message(
+                chat_id=user_id,
+                text=self.text,
+                parse_mode='HTML',  # Linkler için HTML desteği
+                disable_web_page_preview=True,
+                rate_limit_args={'priority': 'broadcast', 'max_retries': BROADCAST_MAX_ATTEMPTS - 1}
+            )
+            self.sent += 1
+            return 'sent'
+        except Forbidden:
+            # Blocked the bot or deactivated; excluded from later broadcasts
+            self.blocked += 1
+            return 'blocked'
+        except TelegramError as e:
+            logger.warning(f"Failed to send message to user {user_id}: {e}")
+        self.failed += 1
+        return 'failed'
+
+    def _progress(self, final=False, resumed=False) -> str:
+        elapsed = time.monotonic() - self.started
+        rate = self.processed / elapsed if elapsed else 0.0
+        if final:
+            header = f"📬 Message sent! (#{self.job_id})"
+        elif resumed:
+            header = f"♻️ Resuming broadcast #{self.job_id}..."
+        else:
+            header = f"📬 Broadcasting #{self.job_id}..."
+        return (
+            f"{header}\n"
+            f"📊 {self.processed}/{self.total} users ({rate:.1f} msg/s)\n"
+            f"✅ Successfully sent to {self.sent} users\n"
+            f"🚫 Blocked the bot: {self.blocked} users\n"
+            f"❌ Failed for {self.failed} users"
+            + (f"\nMessage: {self.text}" if final else "")
+        )
+
+    async def _update_progress(self, final=False):
+        text = self._progress(final)
+        if text == self._progress_text:
+            return
+        try:
+            await self._progress_message.edit_text(text)
+            self._progress_text = text
+        except TelegramError as e:
+            logger.warning(f"Couldn't update broadcast progress: {e}")
+
+    async def _report_progress(self):
+        while not self.done.is_set():
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            try:
+                await self._flush()
+                if not await run_db(user_repository.renew_broadcast_lease, self.job_id, PROCESS_ID):
+                    # We stalled past the lease and another process took the job over
+                    logger.warning(f"Lost the lease on broadcast job {self.job_id}, stopping")
+                    self.task.cancel()
+                    return
+            except Exception as e:
+                logger.warning(f"Couldn't save broadcast progress for job {self.job_id}: {e}")
+            await self._update_progress()
+
+class NotificationQueue:
+    # Background sender for user notifications, paced by its own token bucket so bulk
+    # operations can hand off thousands of messages without waiting on them. Messages
+    # wait in per-chat queues and a chat is only handed to a worker once its per-chat
+    # budget allows another send, so a busy chat (the admin during a launch) never stalls
+    # the workers serving everyone else. Messages that pile up for one chat are merged.
+    MESSAGE_LIMIT = 4096
+
+    def __init__(self, rate: float, workers: int, chat_rate: float, max_pending: int):
+        self.rate = rate
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.max_pending = max_pending
+        self.bot = None
+        self.dropped = 0
+        self._chats = {}  # chat_id -> deque of texts; present while the chat is ready, sending or cooling down
+        self._pending = 0
+        self._ready = None
+        self._tasks = []
+
+    def start(self, bot):
+        self.bot = bot
+        self._limiter = TokenBucket(self.rate)
+        self._ready = asyncio.Queue()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        # Give already committed notifications a chance to go out before cancelling
+        if self._pending:
+            try:
+                await asyncio.wait_for(self._drained.wait(), NOTIFICATION_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._pending:
+            logger.warning(f"Dropping {self._pending} queued notifications on shutdown")
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def enqueue(self, chat_id: int, text: str) -> bool:
+        if self._pending >= self.max_pending:
+            self.dropped += 1
+            logger.warning(f"Notification queue full ({self._pending}), dropping message to {chat_id}")
+            return False
+        messages = self._chats.get(chat_id)
+        if messages is None:
+            self._chats[chat_id] = collections.deque([text])
+            self._ready.put_nowait(chat_id)
+        else:
+            messages.append(text)
+        self._pending += 1
+        self._drained.clear()
+        return True
+
+    def _take_batch(self, messages) -> List[str]:
+        batch = [messages.popleft()]
+        size = len(batch[0])
+        while messages and size + 2 + len(messages[0]) <= self.MESSAGE_LIMIT:
+            size += 2 + len(messages[0])
+            batch.append(messages.popleft())
+        return batch
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            chat_id = await self._ready.get()
+            messages = self._chats[chat_id]
+            batch = self._take_batch(messages)
+            try:
+                await self._send(chat_id, '\n\n'.join(batch))
+            finally:
+                self._pending -= len(batch)
+                if not self._pending:
+                    self._drained.set()
+                if messages:
+                    # Back in line once the chat's budget has refilled, not before
+                    loop.call_later(1 / self.chat_rate, self._ready.put_nowait, chat_id)
+                else:
+                    del self._chats[chat_id]
+
+    async def _send(self, chat_id, text):
+        await self._limiter.acquire()
+        try:
+            await self.bot.send_message(
+                chat_id=chat_id,
+                text=text,
+                rate_limit_args={'priority': 'notification', 'max_retries': NOTIFICATION_MAX_ATTEMPTS - 1}
+            )
+        except TelegramError as e:
+            logger.warning(f"Failed to notify user {chat_id}: {e}")
+
+notification_queue = NotificationQueue(NOTIFICATION_RATE, NOTIFICATION_WORKERS, OUTBOUND_CHAT_RATE, NOTIFICATION_MAX_PENDING)
+
+class OutboundRateLimiter(BaseRateLimiter):
+    # Plugged into the bot, so handler replies, notifications and broadcasts share one
+    # budget. A request first waits for its chat's bucket, then for a global token; a
+    # single dispatcher hands global tokens to the highest-priority waiter. RetryAfter
+    # pauses the global budget and is retried for every class. Network errors are retried
+    # with backoff only in the background classes, where a duplicate is harmless and
+    # nobody is waiting on the reply.
+    PRIORITIES = {'interactive': 0, 'notification': 1, 'broadcast': 2}
+    # Calls that don't send anything to a chat, or that must stay instant
+    UNLIMITED_ENDPOINTS = {'getUpdates', 'getMe', 'setWebhook', 'deleteWebhook', 'getWebhookInfo', 'answerCallbackQuery', 'getFile'}
+
+    def __init__(self, rate: float, chat_rate: float, chat_burst: float, max_retries: int):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats = {}  # chat_id -> TokenBucket
+        self._waiting = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._dispatcher = None
+        self.retried = 0
+
+    async def initialize(self):
+        self._global = TokenBucket(self.rate)
+        self._wakeup = asyncio.Event()
+        self._swept = time.monotonic()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._waiting)
+
+    async def _dispatch(self):
+        while True:
+            while not self._waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            await self._global.acquire()
+            # Popped only once the token is due, so a more urgent late arrival goes first
+            _, _, future = heapq.heappop(self._waiting)
+            if not future.done():
+                future.set_result(None)
+
+    async def _wait_turn(self, priority: int):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._seq), future))
+        self._wakeup.set()
+        await future
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        now = time.monotonic()
+        if now - self._swept > 60:
+            self._chats = {key: bucket for key, bucket in self._chats.items() if not bucket.is_full()}
+            self._swept = now
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _call(self, endpoint, callback, args, kwargs):
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception as e:
+            telegram_errors.inc(endpoint, type(e).__name__)
+            raise
+        finally:
+            telegram_latency.observe(time.perf_counter() - started, endpoint)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in self.UNLIMITED_ENDPOINTS:
+            return await self._call(endpoint, callback, args, kwargs)
+        
+        rate_limit_args = rate_limit_args or {}
+        priority = self.PRIORITIES[rate_limit_args.get('priority', 'interactive')]
+        max_retries = rate_limit_args.get('max_retries', self.max_retries)
+        chat_id = data.get('chat_id')
+        
+        for attempt in range(max_retries + 1):
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire()
+            await self._wait_turn(priority)
+            try:
+                return await self._call(endpoint, callback, args, kwargs)
+            except RetryAfter as e:
+                if attempt == max_retries:
+                    raise
+                logger.warning(f"{endpoint} rate limited, pausing outbound requests for {e.retry_after}s")
+                self._global.pause(e.retry_after)
+            except BadRequest:
+                raise
+            except NetworkError as e:
+                if priority == self.PRIORITIES['interactive'] or attempt == max_retries:
+                    raise
+                logger.debug(f"Network error on {endpoint} to {chat_id} (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+            self.retried += 1
+
+@timed
 async def message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     logger.info(f"/message command from {user.id}")
@@ -795,57 +2578,17 @@ async def message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     message_text = ' '.join(context.args)
     
-    conn = None
-    cursor = None
     try:
-        conn = db_pool.getconn()
-        cursor = conn.cursor()
-        
-        # Tüm kullanıcı ID'lerini al
-        cursor.execute("SELECT user_id FROM users")
-        user_ids = [row[0] for row in cursor.fetchall()]
-        
-        if not user_ids:
-            await update.message.reply_text("❌ No users found in database!")
-            logger.info("No users to send message to")
-            return
-        
-        sent_count = 0
-        failed_count = 0
-        
-        # Her kullanıcıya mesaj gönder
-        for user_id in user_ids:
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=message_text,
-                    parse_mode='HTML',  # Linkler için HTML desteği
-                    disable_web_page_preview=True
-                )
-                sent_count += 1
-                logger.info(f"Message sent to user {user_id}")
-            except Exception as e:
-                failed_count += 1
-                logger.warning(f"Failed to send message to user {user_id}: {e}")
-        
-        # Admin'e özet gönder
-        await update.message.reply_text(
-            f"📬 Message sent!\n"
-            f"✅ Successfully sent to {sent_count} users\n"
-            f"❌ Failed for {failed_count} users\n"
-            f"Message: {message_text}"
-        )
-        logger.info(f"Message broadcast completed: {sent_count} sent, {failed_count} failed")
-        
+        broadcast = await Broadcast.create(context.bot, update.effective_chat.id, message_text)
     except Exception as e:
         logger.error(f"Message broadcast error: {e}", exc_info=True)
         await update.message.reply_text("❌ System error while sending messages. Check logs.")
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            db_pool.putconn(conn)
+        return
+    
+    # Runs in the background so the admin's own updates aren't blocked for the whole broadcast
+    broadcast.start()
 
+@timed
 async def sendcoin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     logger.info(f"/sendcoin command from {user.id}")
@@ -856,11 +2599,20 @@ async def sendcoin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.warning(f"Unauthorized /sendcoin attempt by user {user.id}")
         return
 
+    if not context.args and update.message.reply_to_message:
+        await sendcoin_bulk(update, context)
+        return
+
     # Parametre kontrolü
-    if len(context.args) != 2:
-        await update.message.reply_text("❌ Usage: /sendcoin <@username> <amount>\nExample: /sendcoin @bluegoldnews 50")
+    if len(context.args) not in (2, 3) or (len(context.args) == 3 and context.args[2].lower() != 'export'):
+        await update.message.reply_text(
+            "❌ Usage: /sendcoin <@username> <amount> [export]\nExample: /sendcoin @bluegoldnews 50\n\n"
+            "Add 'export' to also receive the wallets changed since the last export.\n"
+            "For bulk credits send a CSV (<@username or user_id>,<amount>) with the caption /sendcoin."
+        )
         logger.warning("Invalid /sendcoin command format")
         return
+    with_export = len(context.args) == 3
 
     try:
         target_username = context.args[0].lstrip('@')  # @ işaretini kaldır
@@ -872,90 +2624,25 @@ async def sendcoin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.warning(f"Invalid /sendcoin input: {context.args}")
         return
 
-    conn = None
-    cursor = None
     try:
-        conn = db_pool.getconn()
-        cursor = conn.cursor()
-        
         # Kullanıcının varlığını kontrol et
-        cursor.execute("SELECT user_id, balance FROM users WHERE username = %s", (target_username,))
-        user_data = cursor.fetchone()
+        target_user_id = await run_db(user_repository.find_user_id_by_username, target_username)
         
-        if not user_data:
+        if not target_user_id:
             await update.message.reply_text(f"❌ User @{target_username} not found in database!")
             logger.warning(f"User @{target_username} not found for /sendcoin")
             return
         
-        target_user_id, current_balance = user_data
-        
         # Balance'ı güncelle
-        cursor.execute('''
-            UPDATE users 
-            SET balance = balance + %s,
-                updated_at = NOW()
-            WHERE user_id = %s
-            RETURNING balance
-        ''', (amount, target_user_id))
-        
-        new_balance = cursor.fetchone()[0]
-        conn.commit()
+        new_balance = await run_db(user_repository.credit_balance, target_user_id, amount)
         logger.info(f"Sent {amount} Solium to user @{target_username} (ID: {target_user_id}), new balance: {new_balance}")
 
         # Kullanıcıya bildirim gönder
-        try:
-            await context.bot.send_message(
-                chat_id=target_user_id,
-                text=f"🎁 Admin sent you {amount} Solium!\n💰 Your new balance: {new_balance} Solium"
-            )
-            logger.info(f"Notification sent to user @{target_username} (ID: {target_user_id})")
-        except Exception as e:
-            logger.warning(f"Failed to notify user @{target_username} (ID: {target_user_id}): {e}")
-
-        # JSON dosyasını güncelle
-        cursor.execute('''
-            SELECT 
-                user_id, 
-                username, 
-                bsc_address, 
-                balance, 
-                referral_code,
-                referral_count,
-                referral_rewards,
-                created_at 
-            FROM users 
-            WHERE bsc_address IS NOT NULL
-            ORDER BY created_at DESC
-        ''')
-        
-        wallets = []
-        for row in cursor.fetchall():
-            wallets.append({
-                'user_id': row[0],
-                'username': row[1] or 'no_username',
-                'wallet_address': row[2],
-                'balance': row[3],
-                'referral_code': row[4],
-                'referral_count': row[5],
-                'referral_rewards': row[6],
-                'registration_date': row[7].isoformat()
-            })
-        
-        if wallets:
-            filename = f"solium_wallets_{len(wallets)}.json"
-            with open(filename, 'w') as f:
-                json.dump(wallets, f, indent=2, ensure_ascii=False)
-            
-            with open(filename, 'rb') as f:
-                await update.message.reply_document(
-                    document=f,
-                    caption=f"📊 Updated wallet export with {len(wallets)} wallets",
-                    filename=filename
-                )
-            
-            os.remove(filename)
-            logger.info(f"Updated wallet export: {len(wallets)} wallets")
-        
+        notification_queue.enqueue(
+            target_user_id,
+            f"🎁 Admin sent you {amount} Solium!\n💰 Your new balance: {new_balance} Solium"
+        )
+
         # Admin'e onay mesajı
         await update.message.reply_text(
             f"✅ Sent {amount} Solium to user @{target_username}\n"
@@ -965,13 +2652,470 @@ async def sendcoin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Sendcoin error for username @{target_username}: {e}", exc_info=True)
         await update.message.reply_text("❌ System error while sending Solium. Check logs.")
-        if conn:
-            conn.rollback()
+        return
+
+    # Opt-in: only the wallets changed since the last export, not a full-table export.
+    # The credit is already committed, so an export failure must not read as a failed send
+    if with_export:
+        try:
+            count = await send_wallet_export(
+                update,
+                "📊 {count} wallets changed since the last export",
+                ExportOptions(changed_only=True)
+            )
+            logger.info(f"Delta wallet export after /sendcoin: {count} wallets")
+        except Exception as e:
+            logger.error(f"Delta wallet export after /sendcoin failed: {e}", exc_info=True)
+            await update.message.reply_text(
+                "⚠️ Solium was sent, but the wallet export failed. Do not resend.\n"
+                "Run /export_wallets changed to retry the export."
+            )
+
+def parse_bulk_credits(text: str):
+    # Rows of "<@username or user_id>,<amount>"; an optional header row is skipped
+    credits = []
+    errors = []
+    for line, row in enumerate(csv.reader(io.StringIO(text)), start=1):
+        if not row or not ''.join(row).strip():
+            continue
+        if len(row) < 2:
+            errors.append(line)
+            continue
+        target = row[0].strip().lstrip('@')
+        try:
+            amount = int(row[1].strip())
+        except ValueError:
+            if line != 1:
+                errors.append(line)
+            continue
+        if amount <= 0 or not target:
+            errors.append(line)
+            continue
+        if target.isdigit():
+            credits.append((line, int(target), None, amount))
+        else:
+            credits.append((line, None, target, amount))
+    return credits, errors
+
+@timed
+async def sendcoin_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    logger.info(f"Bulk /sendcoin from {user.id}")
+    
+    if user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Admin access required!")
+        logger.warning(f"Unauthorized bulk /sendcoin attempt by user {user.id}")
+        return
+    
+    # CSV sent with a /sendcoin caption, or /sendcoin sent as a reply to the CSV
+    document = update.message.document
+    if not document and update.message.reply_to_message:
+        document = update.message.reply_to_message.document
+    if not document:
+        await update.message.reply_text("❌ Send a CSV file with the caption /sendcoin, or reply /sendcoin to one.")
+        return
+    
+    if document.file_size and document.file_size > BULK_CREDIT_MAX_FILE_SIZE:
+        await update.message.reply_text("❌ File too large for a bulk credit.")
+        return
+    
+    try:
+        telegram_file = await document.get_file()
+        data = await telegram_file.download_as_bytearray()
+        credits, errors = parse_bulk_credits(data.decode('utf-8-sig'))
+    except UnicodeDecodeError:
+        await update.message.reply_text("❌ The file must be UTF-8 CSV: <@username or user_id>,<amount>")
+        return
+    
+    if not credits:
+        await update.message.reply_text("❌ No valid rows found. Expected: <@username or user_id>,<amount>")
+        return
+    
+    try:
+        result = await run_db(user_repository.bulk_credit, credits)
+    except Exception as e:
+        logger.error(f"Bulk sendcoin error: {e}", exc_info=True)
+        await update.message.reply_text("❌ System error while sending Solium. Nothing was credited. Check logs.")
+        return
+    
+    queued = 0
+    for target_user_id, amount, new_balance in result.credited:
+        queued += notification_queue.enqueue(
+            target_user_id,
+            f"🎁 Admin sent you {amount} Solium!\n💰 Your new balance: {new_balance} Solium"
+        )
+    
+    total = sum(amount for _, amount, _ in result.credited)
+    lines = [
+        f"✅ Credited {len(result.credited)} users, {total} Solium in total",
+        f"📨 Notifications queued: {queued}" + (f" ({len(result.credited) - queued} dropped, queue full)" if queued < len(result.credited) else ''),
+    ]
+    if result.unknown:
+        shown = ', '.join(f"{target} (line {line})" for line, target in result.unknown[:20])
+        more = f" and {len(result.unknown) - 20} more" if len(result.unknown) > 20 else ''
+        lines.append(f"❓ Unknown users: {shown}{more}")
+    if errors:
+        shown = ', '.join(str(line) for line in errors[:20])
+        more = f" and {len(errors) - 20} more" if len(errors) > 20 else ''
+        lines.append(f"⚠️ Skipped invalid lines: {shown}{more}")
+    
+    await update.message.reply_text("\n".join(lines))
+    logger.info(f"Bulk credited {total} Solium to {len(result.credited)} users, {len(result.unknown)} unknown, {len(errors)} invalid")
+
+@timed
+async def reload_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Admin access required!")
+        return
+    
+    try:
+        await load_task_catalog()
+        await update.message.reply_text(f"✅ Task catalog reloaded: {len(task_catalog)} tasks")
+    except Exception as e:
+        logger.error(f"Task catalog reload error: {e}", exc_info=True)
+        await update.message.reply_text("❌ Reload failed, keeping the current tasks. Check logs.")
+
+@timed
+async def dbstats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Admin access required!")
+        return
+    
+    stats = db_pool.stats()
+    lines = [
+        f"🗄 Pool: {stats['in_use']} in use / {stats['idle']} idle / {stats['size']} open (max {stats['max']})",
+        f"⏳ Waiting: {stats['waiting']}, timeouts: {stats['timeouts']}, recycled: {stats['recycled']}",
+        f"⏱ Acquire wait: avg {stats['wait_avg_ms']:.1f} ms, max {stats['wait_max_ms']:.1f} ms ({stats['acquired']} acquires)",
+        f"🚦 Flood guard: {flood_guard.throttled} throttled, {flood_guard.coalesced} duplicate callbacks collapsed",
+        f"📤 Outbound: {context.bot.rate_limiter.pending} waiting, {context.bot.rate_limiter.retried} retried",
+    ]
+    
+    statement_stats = sorted(user_repository.statement_stats.items(), key=lambda item: item[1][1], reverse=True)
+    if statement_stats:
+        lines.append("")
+        lines.append("Top statements by total time:")
+        for name, (calls, total, slowest) in statement_stats[:8]:
+            lines.append(f"• {name}: {calls} calls, avg {total / calls * 1000:.1f} ms, max {slowest * 1000:.1f} ms")
+    
+    await update.message.reply_text("\n".join(lines))
+
+class PostgresPersistence(BasePersistence):
+    # Keeps context.user_data in the user_state table. PTB only hands over users whose data
+    # changed, once per update_interval; those calls are collected and written in one
+    # transaction. Users whose flags are all falsy are deleted, so the table (which is
+    # loaded whole on startup) only holds users who are mid-flow.
+    def __init__(self, update_interval: float):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._pending = {}
+        self._flush_task = None
+
+    async def get_user_data(self):
+        states = await run_db(user_repository.load_user_states)
+        logger.info(f"Restored conversation state for {len(states)} users")
+        return states
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_user_data(self, user_id, data):
+        self._pending[user_id] = dict(data) if any(data.values()) else None
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._pending[user_id] = None
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if not self._flush_task:
+            self._flush_task = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        await asyncio.sleep(0)  # let the rest of this persistence pass queue its users first
+        pending, self._pending = self._pending, {}
+        self._flush_task = None
+        if not pending:
+            return
+        try:
+            await run_db(user_repository.save_user_states, pending)
+        except Exception as e:
+            logger.error(f"Failed to persist state for {len(pending)} users: {e}")
+            # Retried with the next pass; newer data for the same user wins
+            for user_id, data in pending.items():
+                self._pending.setdefault(user_id, data)
+
+    async def flush(self):
+        if self._flush_task:
+            await self._flush_task
+        if self._pending:
+            await self._write_pending()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        # Nothing to reload: this process is the only one serving updates (see the webhook
+        # check at the top), so its user_data is always newer than the table
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+class FloodGuard:
+    # Decides before an update is queued whether it is worth running. Each user gets a
+    # token bucket, and a callback identical to one that is still running (or finished
+    # less than CALLBACK_COALESCE_WINDOW ago) is collapsed into that run.
+    def __init__(self, rate: float, burst: float, window: float):
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self._buckets = {}  # user_id -> TokenBucket
+        self._callbacks = {}  # user_id -> (callback data, finished_at or None while running)
+        self._swept = time.monotonic()
+        self.throttled = 0
+        self.coalesced = 0
+
+    def admit(self, user_id, callback_data=None) -> str:
+        # Returns 'ok', 'coalesced' or 'throttled'
+        now = time.monotonic()
+        if now - self._swept > 60:
+            self._sweep(now)
+        
+        if callback_data is not None:
+            previous = self._callbacks.get(user_id)
+            if previous and previous[0] == callback_data and (previous[1] is None or now - previous[1] < self.window):
+                self.coalesced += 1
+                flood_dropped.inc('coalesced')
+                return 'coalesced'
+        
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        if not bucket.try_acquire():
+            self.throttled += 1
+            flood_dropped.inc('throttled')
+            return 'throttled'
+        
+        if callback_data is not None:
+            self._callbacks[user_id] = (callback_data, None)
+        return 'ok'
+
+    def finished(self, user_id, callback_data):
+        previous = self._callbacks.get(user_id)
+        if previous and previous[0] == callback_data:
+            self._callbacks[user_id] = (callback_data, time.monotonic())
+
+    def _sweep(self, now):
+        # A bucket that has refilled is the same as a new one
+        self._buckets = {
+            user_id: bucket for user_id, bucket in self._buckets.items()
+            if not bucket.is_full()
+        }
+        self._callbacks = {
+            user_id: entry for user_id, entry in self._callbacks.items()
+            if entry[1] is None or now - entry[1] < self.window
+        }
+        self._swept = now
+
+flood_guard = FloodGuard(FLOOD_RATE, FLOOD_BURST, CALLBACK_COALESCE_WINDOW)
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    # Runs up to max_running handlers at once, but updates from the same user run one at
+    # a time in arrival order, so the awaiting_* flags and balance writes of a user never
+    # race each other. PTB's own semaphore (max_backlog) only bounds how many updates are
+    # in flight; the handler slots are a separate semaphore taken after the user lock, so
+    # one user's backlog can't occupy slots that other users' updates need.
+    def __init__(self, max_running: int, max_backlog: int):
+        super().__init__(max_backlog)
+        self.max_running = max_running
+        self._running = None
+        self._user_locks = {}  # user_id -> [asyncio.Lock, queued update count]
+
+    @property
+    def pending_updates(self) -> int:
+        return sum(entry[1] for entry in self._user_locks.values())
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._running:
+                await coroutine
+            return
+        
+        query = update.callback_query
+        callback_data = query.data if query else None
+        if user.id != ADMIN_ID:
+            verdict = flood_guard.admit(user.id, callback_data)
+            if verdict != 'ok':
+                coroutine.close()
+                logger.debug(f"Dropped {verdict} update from {user.id}: {callback_data}")
+                if query:
+                    # Stops the client's loading spinner without touching the database
+                    try:
+                        await query.answer("⏳ Slow down a little." if verdict == 'throttled' else None)
+                    except TelegramError:
+                        pass
+                return
+        
+        entry = self._user_locks.get(user.id)
+        if entry is None:
+            entry = self._user_locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[user.id]
+            if callback_data is not None:
+                flood_guard.finished(user.id, callback_data)
+
+    async def initialize(self):
+        self._running = asyncio.Semaphore(self.max_running)
+
+    async def shutdown(self):
+        pass
+
+def register_runtime_gauges(application: Application):
+    metrics.register(Gauge('solium_queue_depth', 'Items waiting in each queue', lambda: {
+        'updates': application.update_queue.qsize(),
+        'processing': application.update_processor.pending_updates,
+        'notifications': notification_queue.pending,
+        'outbound': application.bot.rate_limiter.pending,
+    }, label='queue'))
+    metrics.register(Gauge('solium_db_pool_connections', 'Pooled connections by state', lambda: {
+        state: db_pool.stats()[state] for state in ('in_use', 'idle', 'waiting')
+    }, label='state'))
+    metrics.register(Gauge('solium_active_broadcasts', 'Broadcasts in progress', lambda: len(Broadcast.active)))
+
+metrics_runner = None
+
+async def on_startup(application: Application):
+    global metrics_runner
+    register_runtime_gauges(application)
+    await load_task_catalog()
+    notification_queue.start(application.bot)
+    Broadcast.watch(application.bot)
+    
+    if METRICS_PORT:
+        metrics_runner = web.AppRunner(build_web_app(application, webhook=False, with_metrics=True))
+        await metrics_runner.setup()
+        await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+        logger.info(f"✅ Metrics server listening on {METRICS_HOST}:{METRICS_PORT}")
+
+async def on_shutdown(application: Application):
+    await Broadcast.stop_all()
+    await notification_queue.stop()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+
+def build_web_app(application: Application, webhook: bool, with_metrics: bool = False) -> web.Application:
+    async def telegram_webhook(request):
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            logger.warning(f"Rejected webhook call with bad secret from {request.remote}")
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        return web.Response()
+    
+    async def health(request):
+        healthy = db_pool is not None and not db_pool.closed and application.running
+        return web.json_response(
+            {
+                'status': 'ok' if healthy else 'unavailable',
+                'mode': 'webhook' if WEBHOOK_URL else 'polling',
+                'update_queue': application.update_queue.qsize(),
+                'db_pool': db_pool.stats() if db_pool else None,
+            },
+            status=200 if healthy else 503
+        )
+    
+    async def metrics_endpoint(request):
+        if METRICS_TOKEN:
+            token = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(token, f"Bearer {METRICS_TOKEN}"):
+                return web.Response(status=401)
+        return web.Response(
+            body=metrics.render().encode(),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+    
+    web_app = web.Application()
+    web_app.router.add_get('/health', health)
+    if with_metrics:
+        web_app.router.add_get('/metrics', metrics_endpoint)
+    if webhook:
+        web_app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    return web_app
+
+async def run_webhook(application: Application):
+    runner = web.AppRunner(build_web_app(application, webhook=True))
+    
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.bot.set_webhook(
+        url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        drop_pending_updates=WEBHOOK_DROP_PENDING
+    )
+    await application.start()
+    
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    logger.info(f"✅ Webhook server listening on port {PORT}")
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    try:
+        await stop.wait()
     finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            db_pool.putconn(conn)
+        logger.info("Shutting down webhook server...")
+        await runner.cleanup()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
 
 def main():
     try:
@@ -980,9 +3124,19 @@ def main():
         init_db_pool()
         init_db()
         
-        application = Application.builder().token(BOT_TOKEN).build()
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .concurrent_updates(UserOrderedUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_BACKLOG))
+            .persistence(PostgresPersistence(STATE_FLUSH_INTERVAL))
+            .rate_limiter(OutboundRateLimiter(OUTBOUND_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_MAX_RETRIES))
+            .post_init(on_startup)
+            .post_stop(on_shutdown)
+            .build()
+        )
         
         # Message handler fonksiyonu
+        @timed
         async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if context.user_data.get('awaiting_wallet'):
                 await handle_wallet_address(update, context)
@@ -994,16 +3148,24 @@ def main():
         application.add_handler(CommandHandler('export_wallets', export_wallets))
         application.add_handler(CommandHandler('message', message))
         application.add_handler(CommandHandler('sendcoin', sendcoin))  # Yeni handler
+        application.add_handler(CommandHandler('dbstats', dbstats))
+        application.add_handler(CommandHandler('reload_tasks', reload_tasks))
+        application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r'^/sendcoin(@\w+)?\s*$'), sendcoin_bulk))
         application.add_handler(CallbackQueryHandler(handle_task_button))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
         
-        logger.info("✅ Bot initialized, starting polling...")
-        application.run_polling(
-            drop_pending_updates=True,
-            allowed_updates=Update.ALL_TYPES,
-            poll_interval=1.0,
-            timeout=10
-        )
+        if WEBHOOK_URL:
+            logger.info("✅ Bot initialized, starting webhook...")
+            # Same loop PTB uses for run_polling, so the update queue stays bound to it
+            asyncio.get_event_loop().run_until_complete(run_webhook(application))
+        else:
+            logger.info("✅ Bot initialized, starting polling...")
+            application.run_polling(
+                drop_pending_updates=True,
+                allowed_updates=Update.ALL_TYPES,
+                poll_interval=1.0,
+                timeout=10
+            )
         
     except Exception as e:
         logger.critical(f"Fatal error: {e}")